@@ -0,0 +1,254 @@
+"""
+Headless benchmark for the game and menu loops
+
+Runs main.py under SDL's dummy video and audio drivers, feeds a scripted input trace into input_queue and
+records how long each phase of every frame took. Results are printed and written to a JSON file so runs can
+be compared against each other.
+
+    python bench.py --state game --frames 1200 --seed 1 --output bench.json
+    python bench.py --trace my_trace.json
+    python bench.py --present --frames 300
+    python bench.py --startup --runs 10
+
+--startup starts the game in fresh processes, with and without the asset pack from build_pack.py, and reports
+how long the import, the first menu frame and loading every game asset took.
+
+--present skips the game loop and instead times flip_display() for each way of presenting the display
+(drawing straight to the screen, software scaling and SDL's GPU scaling) at a few common resolutions.
+
+A trace is a JSON list of events, either [frame, action, pressed] for the actions handle_input() produces
+(e.g. [30, "player up", true]) or [frame, "mouse", x, y] to move the mouse.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import main  # noqa: E402
+
+# Walks the player around the starting area and clicks near the middle of the screen
+DEFAULT_TRACE = [
+    [10, "player up", True],
+    [130, "player up", False],
+    [130, "player right", True],
+    [250, "player right", False],
+    [250, "player down", True],
+    [310, "player down", False],
+    [310, "player left", True],
+    [430, "player left", False],
+    [440, "mouse", 640, 360],
+    [450, "left click", True],
+    [451, "left click", False],
+    [460, "player up", True],
+    [460, "player left", True],
+    [580, "player up", False],
+    [580, "player left", False],
+]
+
+
+class BenchmarkFinished(Exception):
+    pass
+
+
+def get_percentile(sorted_values, percentile):
+    index = min(len(sorted_values) - 1, int(round((percentile / 100) * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples):
+    summary = {}
+    for phase in samples:
+        values = sorted(samples[phase])
+        summary[phase] = {
+            "p50": get_percentile(values, 50) * 1000,
+            "p95": get_percentile(values, 95) * 1000,
+            "p99": get_percentile(values, 99) * 1000,
+            "mean": (sum(values) / len(values)) * 1000,
+        }
+    return summary
+
+
+def start_game():
+    # The dummy driver can't go fullscreen at an arbitrary resolution
+    main.windowed = True
+    main.app.start()
+
+
+def run_benchmark(state, frame_count, seed, trace):
+    start_game()
+    main.lockstep = True
+    random.seed(seed)
+    # Load everything up front so the timings don't include the loading screen
+    main.asset_preloader.finish()
+
+    events_by_frame = {}
+    for event in trace:
+        events_by_frame.setdefault(event[0], []).append(event[1:])
+
+    samples = {"frame": []}
+    frame = [0]
+
+    def on_frame(frame_times):
+        for phase in frame_times:
+            samples.setdefault(phase, []).append(frame_times[phase])
+        samples["frame"].append(sum(frame_times.values()))
+
+        frame[0] += 1
+        if frame[0] >= frame_count:
+            raise BenchmarkFinished()
+
+        # Queue up the input for the next frame
+        for event in events_by_frame.get(frame[0], []):
+            if event[0] == "mouse":
+                main.mouse_x, main.mouse_y = event[1], event[2]
+            else:
+                main.input_queue.append((event[0], event[1]))
+                main.input_states[event[0]] = event[1]
+
+    main.profiler.listeners.append(on_frame)
+    try:
+        if state == "menu":
+            main.menu()
+        else:
+            main.game()
+    except BenchmarkFinished:
+        pass
+    finally:
+        main.profiler.listeners.remove(on_frame)
+        main.audio.stop_music()
+
+    return summarize(samples)
+
+
+# Resolutions compared by --present, one for each aspect ratio data/settings.txt supports plus 1080p
+PRESENT_RESOLUTIONS = [(1280, 720), (1920, 1080), (1024, 768), (1680, 1050)]
+
+
+def run_present_benchmark(frame_count):
+    start_game()
+
+    results = {}
+    for screen_width, screen_height in PRESENT_RESOLUTIONS:
+        for gpu in (False, True):
+            # SDL can't always switch an open window over to GPU scaling, so each mode starts from a fresh window
+            main.pygame.display.quit()
+            main.pygame.display.init()
+            main.set_display_mode(screen_width, screen_height, gpu)
+            name = str(screen_width) + "x" + str(screen_height) + " " + main.present_mode
+            if name in results:
+                # GPU scaling wasn't available or wasn't needed at this size
+                continue
+
+            samples = {"full": [], "dirty": []}
+            dirty_rects = [main.pygame.Rect(128, 0, 1024, 120), main.pygame.Rect(600, 300, 80, 120)]
+            for i in range(0, frame_count):
+                main.render_background("b_background", i, i)
+                for kind in ("full", "dirty"):
+                    start_time = time.perf_counter()
+                    main.flip_display(None if kind == "full" else dirty_rects)
+                    samples[kind].append(time.perf_counter() - start_time)
+            results[name] = summarize(samples)
+
+    return results
+
+
+# Run in a fresh interpreter by run_startup_benchmark(), prints the startup timings as JSON
+STARTUP_SCRIPT = """
+import sys, time, json
+start_time = time.perf_counter()
+import main
+timings = {"import": time.perf_counter() - start_time}
+main.parse_flags(sys.argv)
+main.app.start()
+timings["start"] = time.perf_counter() - start_time
+
+class FirstFrame(Exception):
+    pass
+
+def on_frame(frame_times):
+    raise FirstFrame()
+
+main.profiler.listeners.append(on_frame)
+try:
+    main.menu()
+except FirstFrame:
+    pass
+timings["first menu frame"] = time.perf_counter() - start_time
+main.asset_preloader.finish()
+timings["game assets loaded"] = time.perf_counter() - start_time
+print(json.dumps(timings))
+"""
+
+
+def run_startup_benchmark(runs):
+    results = {}
+    for name, flags in (("png", ["--nopack"]), ("pack", [])):
+        samples = {}
+        for i in range(0, runs):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, "--windowed"] + flags, capture_output=True, text=True, check=True).stdout
+            timings = json.loads(output.splitlines()[-1])
+            for key in timings:
+                samples.setdefault(key, []).append(timings[key])
+        results[name] = summarize(samples)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the game headless and report per-phase frame timings")
+    parser.add_argument("--state", choices=["game", "menu"], default="game")
+    parser.add_argument("--frames", type=int, default=1200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="JSON input trace, defaults to a short walk around the start area")
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--present", action="store_true", help="Compare presentation modes instead of running the game")
+    parser.add_argument("--startup", action="store_true", help="Time startup with and without the asset pack instead of running the game")
+    parser.add_argument("--runs", type=int, default=10, help="Number of processes started for each loader by --startup")
+    args = parser.parse_args()
+
+    if args.startup:
+        if not os.path.isfile("res/assets.pack"):
+            print("No asset pack found, run build_pack.py first")
+            sys.exit(1)
+        results = run_startup_benchmark(args.runs)
+        print("loader   step                   p50 ms    p95 ms")
+        for name in results:
+            for step in results[name]:
+                print(name.ljust(9) + step.ljust(20) + "".join(("%.1f" % results[name][step][key]).rjust(10) for key in ("p50", "p95")))
+        with open(args.output, "w") as output_file:
+            json.dump({"startup": True, "loaders": results}, output_file, indent=4)
+        print("Results written to " + args.output)
+        sys.exit(0)
+
+    if args.present:
+        results = run_present_benchmark(args.frames)
+        print("mode                   frame   p50 ms    p95 ms    p99 ms")
+        for name in results:
+            for kind in results[name]:
+                print(name.ljust(22) + kind.ljust(6) + "".join(("%.3f" % results[name][kind][key]).rjust(10) for key in ("p50", "p95", "p99")))
+        with open(args.output, "w") as output_file:
+            json.dump({"present": True, "frames": args.frames, "modes": results}, output_file, indent=4)
+        print("Results written to " + args.output)
+        sys.exit(0)
+
+    trace = DEFAULT_TRACE
+    if args.trace is not None:
+        trace = json.load(open(args.trace))
+
+    results = run_benchmark(args.state, args.frames, args.seed, trace)
+
+    print("phase        p50 ms    p95 ms    p99 ms")
+    for phase in results:
+        print(phase.ljust(10) + "".join(("%.3f" % results[phase][key]).rjust(10) for key in ("p50", "p95", "p99")))
+    image_stats = main.image_cache.get_stats()
+    print("image cache: " + str(image_stats["hits"]) + " hits, " + str(image_stats["misses"]) + " misses, " + str(image_stats["evictions"]) + " evictions, " + ("%.1f" % (image_stats["resident_bytes"] / (1024 * 1024))) + " MB resident")
+
+    with open(args.output, "w") as output_file:
+        json.dump({"state": args.state, "frames": args.frames, "seed": args.seed, "phases": results, "image_cache": image_stats}, output_file, indent=4)
+    print("Results written to " + args.output)
@@ -0,0 +1,60 @@
+"""
+Builds res/assets.pack, every PNG in res/gfx stored as raw pixels so the game doesn't have to decode them
+
+    python build_pack.py
+
+The pack starts with PACK_MAGIC, a version and the length of a JSON index, followed by the index and then the
+pixel data. The index maps each image name to its offset, size, pixel format and spritesheet frame size (if the
+game uses it as one). Pixels are stored as BGRA, the byte order of a 32 bit display surface, so converting them
+at runtime is a straight copy. Rebuild the pack whenever an image changes, the game ignores a pack older than the
+images it was built from.
+"""
+import os
+import sys
+import json
+import struct
+
+import main
+
+
+def build_pack(output_path):
+    frame_sizes = {}
+    for kind, path, argument in main.GAME_ASSETS:
+        if kind == main.ASSET_SPRITESHEET:
+            frame_sizes[path] = argument
+
+    index = {}
+    pixel_data = []
+    offset = 0
+    for file_name in sorted(os.listdir(main.image_path)):
+        if not file_name.endswith(".png"):
+            continue
+        name = file_name[:-4]
+        image = main.pygame.image.load(main.image_path + file_name)
+        pixels = main.pygame.image.tobytes(image, main.PACK_PIXEL_FORMAT)
+        index[name] = {"offset": offset, "size": image.get_size(), "format": main.PACK_PIXEL_FORMAT, "frame_size": frame_sizes.get(name)}
+        pixel_data.append(pixels)
+        # Keeps every image aligned for the copy into a surface
+        padding = (-len(pixels)) % main.PACK_ALIGNMENT
+        pixel_data.append(bytes(padding))
+        offset += len(pixels) + padding
+
+    index_bytes = json.dumps(index).encode("utf-8")
+    header_size = struct.calcsize(main.PACK_HEADER_FORMAT)
+    data_start = header_size + len(index_bytes)
+    data_start += (-data_start) % main.PACK_ALIGNMENT
+    with open(output_path, "wb") as pack_file:
+        pack_file.write(struct.pack(main.PACK_HEADER_FORMAT, main.PACK_MAGIC, main.PACK_VERSION, len(index_bytes)))
+        pack_file.write(index_bytes)
+        pack_file.write(bytes(data_start - header_size - len(index_bytes)))
+        for chunk in pixel_data:
+            pack_file.write(chunk)
+
+    print("Packed " + str(len(index)) + " images into " + output_path + " (" + str(data_start + offset) + " bytes)")
+
+
+if __name__ == "__main__":
+    output_path = "res/assets.pack"
+    if len(sys.argv) > 1:
+        output_path = sys.argv[1]
+    build_pack(output_path)
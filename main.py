@@ -1,15 +1,56 @@
 import pygame
 import sys
+import collections
 import os
 import math
 import random
+import time
+import json
+import io
+import mmap
+import struct
+import queue
+import threading
+import numpy
+
+from scenario import generate_scenario
 
 # Handle cli flags
-windowed = "--windowed" in sys.argv
-show_fps = "--showfps" in sys.argv
-if "--debug" in sys.argv:
-    windowed = True
-    show_fps = True
+windowed = False
+show_fps = False
+uncapped = False
+use_asset_pack = True
+seed = None
+record_path = None
+replay_path = None
+
+
+def get_flag_value(argv, flag):
+    """
+    Returns the argument following flag, or None if the flag wasn't given
+    """
+    if flag in argv and argv.index(flag) + 1 < len(argv):
+        return argv[argv.index(flag) + 1]
+    return None
+
+
+def parse_flags(argv):
+    global windowed, show_fps, uncapped, use_asset_pack, seed, record_path, replay_path
+
+    windowed = "--windowed" in argv
+    show_fps = "--showfps" in argv
+    uncapped = "--uncapped" in argv
+    use_asset_pack = "--nopack" not in argv
+    if "--debug" in argv:
+        windowed = True
+        show_fps = True
+    if get_flag_value(argv, "--seed") is not None:
+        seed = int(get_flag_value(argv, "--seed"))
+    record_path = get_flag_value(argv, "--record")
+    replay_path = get_flag_value(argv, "--replay")
+    if replay_path is not None:
+        # Replays run headless, and the dummy video driver can't go fullscreen
+        windowed = True
 
 
 # Resolution variables, Display is streched to match Screen which can be set by user
@@ -18,55 +59,348 @@ DISPLAY_HEIGHT = 720
 SCREEN_WIDTH = 1280
 SCREEN_HEIGHT = 720
 
-if os.path.isfile("data/settings.txt"):
-    print("Settings file found!")
-    video_settings = open("data/settings.txt").read().splitlines()
-    for line in video_settings:
-        if line.startswith("resolution="):
-            SCREEN_WIDTH = int(line[line.index("=") + 1:line.index("x")])
-            SCREEN_HEIGHT = int(line[line.index("x") + 1:])
-            aspect_ratio = SCREEN_WIDTH / SCREEN_HEIGHT
-            if aspect_ratio == 4 / 3:
-                DISPLAY_HEIGHT = 960
-            elif aspect_ratio == 16 / 10:
-                DISPLAY_HEIGHT = 840
-            elif aspect_ratio == 16 / 9:
-                DISPLAY_HEIGHT = 720
-else:
-    print("No settings file found!")
-print("Resolution set to " + str(SCREEN_WIDTH) + "x" + str(SCREEN_HEIGHT) + ".")
-
-SCALE = SCREEN_WIDTH / DISPLAY_WIDTH
+# Ways of getting the display onto the screen, see set_display_mode()
+PRESENT_DIRECT = "direct"
+PRESENT_SCALE = "scale"
+PRESENT_GPU = "gpu"
+gpu_scaling = False
+
+
+def get_display_height(screen_width, screen_height):
+    """
+    Returns the display height that keeps the screen's aspect ratio with a display width of DISPLAY_WIDTH
+    """
+    aspect_ratio = screen_width / screen_height
+    if aspect_ratio == 4 / 3:
+        return 960
+    elif aspect_ratio == 16 / 10:
+        return 840
+    return 720
+
+
+def load_settings():
+    global SCREEN_WIDTH, SCREEN_HEIGHT, DISPLAY_HEIGHT, gpu_scaling
+
+    if os.path.isfile("data/settings.txt"):
+        print("Settings file found!")
+        video_settings = open("data/settings.txt").read().splitlines()
+        for line in video_settings:
+            if line.startswith("resolution="):
+                SCREEN_WIDTH = int(line[line.index("=") + 1:line.index("x")])
+                SCREEN_HEIGHT = int(line[line.index("x") + 1:])
+                DISPLAY_HEIGHT = get_display_height(SCREEN_WIDTH, SCREEN_HEIGHT)
+            elif line.startswith("scaling="):
+                gpu_scaling = line[line.index("=") + 1:].strip() == "gpu"
+            elif line.startswith("image_cache_mb="):
+                image_cache.budget = int(line[line.index("=") + 1:]) * 1024 * 1024
+            elif line.startswith("bind_"):
+                # e.g. bind_player_up=up or bind_kill=k, using pygame's key names
+                action = line[len("bind_"):line.index("=")].replace("_", " ")
+                key_name = line[line.index("=") + 1:].strip()
+                try:
+                    bind_key(action, pygame.key.key_code(key_name))
+                except ValueError:
+                    print("Unknown key " + key_name + " for " + action)
+    else:
+        print("No settings file found!")
+    print("Resolution set to " + str(SCREEN_WIDTH) + "x" + str(SCREEN_HEIGHT) + ".")
 
 # Timing variables
 TARGET_FPS = 60
 SECOND = 1000
 UPDATE_TIME = SECOND / 60.0
+MAX_UPDATES_PER_FRAME = 5
 fps = 0
 frames = 0
-dt = 0
+dt = 1
+update_steps = 0
+update_accumulator = 0
+interpolation = 0
 before_time = 0
 before_sec = 0
+lockstep = False  # Runs exactly one update per frame without waiting, for benchmarks
+
+# Display, created by Application.start()
+SCALE = 1
+present_mode = PRESENT_SCALE
+present_scale_x = 1
+present_scale_y = 1
+screen = None
+display = None
+
+
+def set_display_mode(screen_width, screen_height, gpu=False):
+    """
+    Opens the window and picks how the display gets presented on it. When the sizes match the game draws
+    straight onto the screen, when gpu is set SDL scales the window with the renderer, otherwise the display
+    is scaled onto the screen with nearest neighbour scaling each frame
+    """
+    global SCREEN_WIDTH, SCREEN_HEIGHT, DISPLAY_HEIGHT, SCALE, screen, display
+    global present_mode, present_scale_x, present_scale_y
+
+    SCREEN_WIDTH, SCREEN_HEIGHT = screen_width, screen_height
+    DISPLAY_HEIGHT = get_display_height(screen_width, screen_height)
+
+    flags = 0
+    if not windowed:
+        flags = pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.FULLSCREEN
+
+    screen = None
+    if gpu and (screen_width, screen_height) != (DISPLAY_WIDTH, DISPLAY_HEIGHT):
+        # The window is opened at display size and SDL stretches it, mouse positions come back in display units
+        try:
+            screen = pygame.display.set_mode((DISPLAY_WIDTH, DISPLAY_HEIGHT), flags | pygame.SCALED)
+            present_mode = PRESENT_GPU
+            display = screen
+        except pygame.error as error:
+            print("Could not use GPU scaling, falling back to software scaling: " + str(error))
+    if screen is None:
+        screen = pygame.display.set_mode((screen_width, screen_height), flags, 32)
+        if screen.get_size() == (DISPLAY_WIDTH, DISPLAY_HEIGHT):
+            present_mode = PRESENT_DIRECT
+            display = screen
+        else:
+            present_mode = PRESENT_SCALE
+            display = pygame.Surface((DISPLAY_WIDTH, DISPLAY_HEIGHT)).convert()
+
+    present_scale_x = screen.get_width() / DISPLAY_WIDTH
+    present_scale_y = screen.get_height() / DISPLAY_HEIGHT
+    SCALE = present_scale_x
+
 
-# Init pygame
-os.environ['SDL_VIDEO_CENTERED'] = '1'
-pygame.init()
-global screen
-if windowed:
-    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), 0, 32)
-else:
-    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.HWSURFACE | pygame.DOUBLEBUF | pygame.FULLSCREEN)
-display = pygame.Surface((DISPLAY_WIDTH, DISPLAY_HEIGHT))
 clock = pygame.time.Clock()
 
 
-# Input variables
-input_queue = []
+class Application():
+    """
+    Starts pygame, reads the settings, opens the window, maps the asset pack and sets up audio. None of this
+    happens when main is imported, so tools can use the rest of the module without a window
+    """
+
+    def __init__(self):
+        self.started = False
+
+    def start(self):
+        global asset_pack, seed, input_recorder, input_replay
+
+        if self.started:
+            return
+        self.started = True
+
+        if replay_path is not None:
+            input_replay = InputReplay(replay_path)
+            seed = input_replay.seed
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
+        elif record_path is not None:
+            if seed is None:
+                seed = random.randrange(1 << 32)
+            input_recorder = InputRecorder(record_path, seed)
+        if seed is not None:
+            random.seed(seed)
+
+        os.environ['SDL_VIDEO_CENTERED'] = '1'
+        pygame.init()
+        load_settings()
+        set_display_mode(SCREEN_WIDTH, SCREEN_HEIGHT, gpu_scaling)
+        asset_pack = open_asset_pack()
+        audio.start()
+        for track in MUSIC_TRACKS:
+            audio.preload(track)
+        if input_recorder is not None or input_replay is not None:
+            # How long loading takes varies from run to run, so it's all done up front to keep frames lined up
+            asset_preloader.finish()
+
+
+app = Application()
+
+
+# Input variables, keys and mouse buttons are bound to actions that are queued as (action, pressed) events
+DEFAULT_KEY_BINDINGS = {pygame.K_w: "player up", pygame.K_d: "player right", pygame.K_s: "player down", pygame.K_a: "player left", pygame.K_x: "kill"}
+MOUSE_BINDINGS = {pygame.BUTTON_LEFT: "left click"}
+key_bindings = dict(DEFAULT_KEY_BINDINGS)
+input_queue = collections.deque()
 input_states = {"player up": False, "player right": False, "player down": False, "player left": False, "left click": False}
 mouse_x = 0
 mouse_y = 0
 
 
+def bind_key(action, key):
+    """
+    Makes key trigger action, replacing whichever key triggered it before
+    """
+    for bound_key in [bound_key for bound_key in key_bindings if key_bindings[bound_key] == action]:
+        del key_bindings[bound_key]
+    key_bindings[key] = action
+
+
+# Recording and replay, --record saves the input of a session and --replay plays it back headless as fast as
+# possible. Both seed random, so the replay gets the same scenario and steps through the same frames
+RECORDING_VERSION = 3
+input_recorder = None
+input_replay = None
+sync_entities = []  # The player and NPCs of the running game, set by game()
+
+
+def get_sync_check():
+    """
+    Returns a hash of the random number generator's state and where the player and NPCs are. The recorder and
+    replay fold it in every frame, so a replay that ends with a different value went out of sync at some point
+    """
+    # Only the integers of the random state, the rest of the tuple can hash differently between processes
+    return hash((random.getstate()[1], tuple((float(entity.x), float(entity.y)) for entity in sync_entities)))
+
+
+class InputRecorder():
+    """
+    Logs the events handle_input() queues each frame along with the mouse position and how many update steps the
+    frame ran, only writing down frames that differ from a plain single step with no input. The interpolation a
+    frame renders at isn't needed, the game only goes by positions as of the last update step
+    """
+
+    def __init__(self, path, seed):
+        self.path = path
+        self.seed = seed
+        self.frame = 0
+        self.frames = []
+        self.mouse = (0, 0)
+        self.sync_check = 0
+
+    def record_frame(self, events):
+        self.frame += 1
+        self.sync_check = hash((self.sync_check, get_sync_check()))
+        if len(events) != 0 or update_steps != 1 or (mouse_x, mouse_y) != self.mouse:
+            self.frames.append([self.frame, update_steps, mouse_x, mouse_y, events])
+            self.mouse = (mouse_x, mouse_y)
+
+    def save(self, quitting):
+        """
+        Writes the recording. If the game is quitting mid-frame, that frame is when the replay quits too
+        """
+        recording = {
+            "version": RECORDING_VERSION,
+            "seed": self.seed,
+            "frame_count": self.frame + 1 if quitting else self.frame,
+            "quit": quitting,
+            "sync_check": hash((self.sync_check, get_sync_check())),
+            "frames": self.frames,
+        }
+        with open(self.path, "w") as recording_file:
+            json.dump(recording, recording_file, separators=(",", ":"))
+        print("Recorded " + str(recording["frame_count"]) + " frames to " + self.path)
+
+
+class InputReplay():
+    """
+    Stands in for the keyboard, mouse and frame timing while playing back a recording from InputRecorder
+    """
+
+    def __init__(self, path):
+        recording = json.load(open(path))
+        if recording["version"] != RECORDING_VERSION:
+            raise ValueError(path + " is a version " + str(recording["version"]) + " recording, expected version " + str(RECORDING_VERSION))
+        self.seed = recording["seed"]
+        self.frame_count = recording["frame_count"]
+        self.quit = recording["quit"]
+        self.sync_check = recording["sync_check"]
+        self.frames = {}
+        for entry in recording["frames"]:
+            self.frames[entry[0]] = entry
+        self.frame = 0
+        self.start_time = 0
+        self.running_sync_check = 0
+
+    def play_frame(self):
+        global update_steps, interpolation, mouse_x, mouse_y
+
+        if self.frame == 0:
+            self.start_time = time.perf_counter()
+        self.frame += 1
+        if self.quit and self.frame == self.frame_count:
+            self.finish()
+            pygame.quit()
+            sys.exit()
+        self.running_sync_check = hash((self.running_sync_check, get_sync_check()))
+
+        # Frames are drawn at the last update step, like in lockstep
+        interpolation = 1
+        entry = self.frames.get(self.frame)
+        if entry is None:
+            update_steps = 1
+            return
+        update_steps = entry[1]
+        mouse_x, mouse_y = entry[2], entry[3]
+        for action, pressed in entry[4]:
+            input_queue.append((action, pressed))
+            input_states[action] = pressed
+
+    def finish(self):
+        elapsed = time.perf_counter() - self.start_time
+        print("Replayed " + str(self.frame) + " of " + str(self.frame_count) + " frames in " + ("%.2f" % elapsed) + "s, " + ("%.3f" % (elapsed * SECOND / max(self.frame, 1))) + "ms per frame")
+        if self.frame != self.frame_count or hash((self.running_sync_check, get_sync_check())) != self.sync_check:
+            print("Replay went out of sync with the recording")
+
+
+def end_session(quitting):
+    """
+    Saves the recording or reports on the replay, if there is one, before the game exits
+    """
+    if input_recorder is not None:
+        input_recorder.save(quitting)
+    if input_replay is not None:
+        input_replay.finish()
+
+
+# Profiling, each frame is split into named phases so slow frames can be traced to a part of the loop
+PROFILER_HISTORY = 240
+# "collision", "npcs" and "background" are scopes inside the game loop's update and render, timed apart from them
+PROFILER_PHASES = ["input", "update", "collision", "npcs", "render", "background", "overlay", "present"]
+
+
+class FrameProfiler():
+    def __init__(self):
+        self.phase_name = None
+        self.phase_start = 0
+        self.frame_times = {}
+        self.history = collections.deque(maxlen=PROFILER_HISTORY)
+        self.listeners = []
+
+    def phase(self, name):
+        """
+        Ends the phase currently being timed, if any, and starts timing a new one
+        """
+        now = time.perf_counter()
+        if self.phase_name is not None:
+            self.frame_times[self.phase_name] = self.frame_times.get(self.phase_name, 0) + (now - self.phase_start)
+        self.phase_name = name
+        self.phase_start = now
+
+    def end_frame(self):
+        self.phase(None)
+        frame_times = self.frame_times
+        self.frame_times = {}
+        self.history.append(frame_times)
+        for listener in self.listeners:
+            listener(frame_times)
+
+    def get_averages(self):
+        averages = {}
+        for phase in PROFILER_PHASES:
+            averages[phase] = sum(frame_times.get(phase, 0) for frame_times in self.history) / max(len(self.history), 1)
+        return averages
+
+    def dump_csv(self, path):
+        with open(path, "w") as csv_file:
+            csv_file.write("frame," + ",".join(PROFILER_PHASES) + ",total\n")
+            for frame_number, frame_times in enumerate(self.history):
+                values = [frame_times.get(phase, 0) * SECOND for phase in PROFILER_PHASES]
+                csv_file.write(str(frame_number) + "," + ",".join("%.4f" % value for value in values) + ",%.4f\n" % sum(values))
+        print("Frame timings written to " + path)
+
+
+profiler = FrameProfiler()
+
+
 # Color variables
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -79,43 +413,252 @@ YELLOW = (255, 255, 0)
 
 # Images
 image_path = "res/gfx/"
-image_cache = {}
+IMAGE_CACHE_BUDGET = 128 * 1024 * 1024  # Bytes of images kept loaded before the least recently used are dropped
 
 
-def get_sprite(path, index, size):
-    base_sheet = get_image(path, True)
-    coords = (0, 0)
-    while index != 0:
-        coords = (coords[0] + size[0], coords[1])
-        if coords[0] >= base_sheet.get_width():
-            coords = (0, coords[1] + size[1])
-            if size[1] >= base_sheet.get_height():
-                print("Spritesheet index out of range! " + path + ", " + str(index))
-        index -= 1
-    return base_sheet.subsurface(coords[0], coords[1], size[0], size[1])
+def get_surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
 
 
-def get_image(path, has_alpha, alpha=255, subrect=None):
-    global image_cache
+class ImageCache():
+    """
+    Least recently used cache of surfaces, entries are dropped once the bytes they hold go over the budget
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.listeners = []
 
-    if path not in image_cache.keys():
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, surface, size=None):
+        """
+        Stores a surface, or anything else holding pixels such as a grid of background tiles if its size in bytes
+        is given
+        """
+        if size is None:
+            size = get_surface_bytes(surface)
+        if key in self.entries:
+            self.resident_bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (surface, size)
+        self.resident_bytes += size
+        # The newest entry is always kept, even when it is bigger than the whole budget
+        while self.resident_bytes > self.budget and len(self.entries) > 1:
+            evicted_key, evicted_entry = self.entries.popitem(last=False)
+            self.resident_bytes -= evicted_entry[1]
+            self.evictions += 1
+            for listener in self.listeners:
+                listener(evicted_key)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "resident_bytes": self.resident_bytes, "budget": self.budget}
+
+
+image_cache = ImageCache(IMAGE_CACHE_BUDGET)
+sprite_cache = {}
+preloaded_images = {}
+
+# Asset pack, built by build_pack.py, holds every image as raw pixels so they can be used without decoding a PNG
+ASSET_PACK_PATH = "res/assets.pack"
+PACK_MAGIC = b"CCPK"
+PACK_VERSION = 1
+PACK_HEADER_FORMAT = "<4sII"
+PACK_PIXEL_FORMAT = "BGRA"
+PACK_ALIGNMENT = 16
+
+
+class AssetPack():
+    """
+    A memory mapped asset pack, surfaces are built straight from the mapped pixels
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_length = struct.unpack_from(PACK_HEADER_FORMAT, self.data)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError("Unsupported asset pack " + path)
+        header_size = struct.calcsize(PACK_HEADER_FORMAT)
+        self.index = json.loads(self.data[header_size:header_size + index_length].decode("utf-8"))
+        self.data_start = header_size + index_length
+        self.data_start += (-self.data_start) % PACK_ALIGNMENT
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get_image(self, name):
+        entry = self.index[name]
+        start = self.data_start + entry["offset"]
+        length = entry["size"][0] * entry["size"][1] * 4
+        return pygame.image.frombuffer(memoryview(self.data)[start:start + length], entry["size"], entry["format"])
+
+
+def open_asset_pack():
+    """
+    Returns the asset pack, or None if there isn't one or it is older than the images in image_path
+    """
+    if not use_asset_pack or not os.path.isfile(ASSET_PACK_PATH):
+        return None
+    pack_time = os.path.getmtime(ASSET_PACK_PATH)
+    for file_name in os.listdir(image_path):
+        if os.path.getmtime(image_path + file_name) > pack_time:
+            print("Asset pack is out of date, run build_pack.py to rebuild it")
+            return None
+    try:
+        return AssetPack(ASSET_PACK_PATH)
+    except (ValueError, struct.error) as error:
+        print(str(error))
+        return None
+
+
+asset_pack = None
+
+
+def read_image_file(path):
+    """
+    Returns the unconverted image for path from the asset pack, or by decoding its PNG if it isn't packed
+    """
+    if asset_pack is not None and path in asset_pack:
+        return asset_pack.get_image(path)
+    return pygame.image.load(image_path + path + ".png")
+
+
+def get_sprite_frames(path, size):
+    """
+    Slices a spritesheet into its frames the first time it is requested so that later lookups are a tuple index
+    """
+    key = (path, size)
+    if key not in sprite_cache:
+        base_sheet = get_image(path, True)
+        columns = base_sheet.get_width() // size[0]
+        rows = base_sheet.get_height() // size[1]
+        if columns == 0 or rows == 0 or base_sheet.get_width() % size[0] != 0 or base_sheet.get_height() % size[1] != 0:
+            print("Spritesheet size doesn't match frame size! " + path + ", " + str(size))
+        frames = []
+        for row in range(0, rows):
+            for column in range(0, columns):
+                frames.append(base_sheet.subsurface(column * size[0], row * size[1], size[0], size[1]))
+        sprite_cache[key] = tuple(frames)
+    else:
+        # The frames share the sheet's pixels, so using them counts as using the sheet
+        image_cache.get(path)
+
+    return sprite_cache[key]
+
+
+def forget_sprite_frames(key):
+    """
+    Drops the frames of a spritesheet that was evicted from the image cache so its pixels can be freed
+    """
+    for sprite_key in [sprite_key for sprite_key in sprite_cache if sprite_key[0] == key]:
+        del sprite_cache[sprite_key]
+
+
+image_cache.listeners.append(forget_sprite_frames)
+
+
+def get_sprite(path, index, size, flip_x=False, flip_y=False):
+    if not flip_x and not flip_y:
+        return get_sprite_frames(path, size)[index]
+
+    key = (path, size, index, flip_x, flip_y)
+    flipped_sprite = image_cache.get(key)
+    if flipped_sprite is None:
+        flipped_sprite = pygame.transform.flip(get_sprite_frames(path, size)[index], flip_x, flip_y)
+        image_cache.put(key, flipped_sprite)
+
+    return flipped_sprite
+
+
+def load_image_file(path):
+    """
+    Returns the decoded but unconverted image for path, taking it from the preloader if it already read it
+    """
+    if path in preloaded_images:
+        return preloaded_images.pop(path)
+    return read_image_file(path)
+
+
+def get_image(path, has_alpha, alpha=255, subrect=None):
+    """
+    Returns a cached image. A faded image or a part of one is a subsurface of the cached image, it shares its
+    pixels but has its own alpha so that fading it doesn't change the image for everyone else
+    """
+    image = image_cache.get(path)
+    if image is None:
         if has_alpha:
-            image_cache[path] = pygame.image.load(image_path + path + ".png").convert_alpha()
+            image = load_image_file(path).convert_alpha()
         else:
-            image_cache[path] = pygame.image.load(image_path + path + ".png").convert()
+            image = load_image_file(path).convert()
+        image_cache.put(path, image)
+
+    if subrect is not None:
+        image = image.subsurface(pygame.Rect(subrect))
+    elif alpha != 255:
+        image = image.subsurface(image.get_rect())
 
-    return_path = path
     if alpha != 255:
-        return_path = path + "&alpha=" + str(alpha)
-        if return_path not in image_cache.keys():
-            new_image = image_cache[path].copy()
-            new_image.fill((255, 255, 255, alpha), None, pygame.BLEND_RGBA_MULT)
-            image_cache[return_path] = new_image
+        image.set_alpha(alpha)
 
-    if subrect is not None:
-        return image_cache[return_path].subsurface(pygame.Rect(subrect))
-    else:
-        return image_cache[return_path]
+    return image
+
+
+# Background, split into tiles so that only the part of the map under the camera is drawn
+BACKGROUND_TILE_SIZE = 512
+
+
+def get_background_tiles(path):
+    """
+    Loads a background image and copies it into a grid of tiles, the full size image isn't kept around afterwards.
+    The grid is kept in the image cache so that it counts against the same budget as every other image
+    """
+    tiles = image_cache.get(("background", path))
+    if tiles is None:
+        tiles = split_into_tiles(load_image_file(path).convert())
+        put_background_tiles(path, tiles)
+
+    return tiles
+
+
+def put_background_tiles(path, tiles):
+    image_cache.put(("background", path), tiles, sum(get_surface_bytes(tile) for row in tiles for tile in row))
+
+
+def split_into_tiles(full_image):
+    tiles = []
+    for tile_y in range(0, full_image.get_height(), BACKGROUND_TILE_SIZE):
+        row = []
+        for tile_x in range(0, full_image.get_width(), BACKGROUND_TILE_SIZE):
+            tile_rect = pygame.Rect(tile_x, tile_y, BACKGROUND_TILE_SIZE, BACKGROUND_TILE_SIZE).clip(full_image.get_rect())
+            row.append(full_image.subsurface(tile_rect).copy())
+        tiles.append(row)
+    return tiles
+
+
+def render_background(path, camera_x, camera_y):
+    tiles = get_background_tiles(path)
+    first_column = max(camera_x // BACKGROUND_TILE_SIZE, 0)
+    last_column = min((camera_x + DISPLAY_WIDTH - 1) // BACKGROUND_TILE_SIZE, len(tiles[0]) - 1)
+    first_row = max(camera_y // BACKGROUND_TILE_SIZE, 0)
+    last_row = min((camera_y + DISPLAY_HEIGHT - 1) // BACKGROUND_TILE_SIZE, len(tiles) - 1)
+    for row in range(first_row, last_row + 1):
+        for column in range(first_column, last_column + 1):
+            display.blit(tiles[row][column], ((column * BACKGROUND_TILE_SIZE) - camera_x, (row * BACKGROUND_TILE_SIZE) - camera_y))
 
 
 def rotate_image(image, angle, origin_pos=None):
@@ -141,6 +684,8 @@ def rotate_image(image, angle, origin_pos=None):
 
 
 class Animation():
+    __slots__ = ("spritesheet", "size", "frames", "frame_duration", "index", "timer", "looped")
+
     def __init__(self, spritesheet, size, frames, frame_duration):
         self.spritesheet = spritesheet
         self.size = size
@@ -150,6 +695,9 @@ class Animation():
         self.timer = 0
         self.looped = False
 
+        if len(get_sprite_frames(spritesheet, size)) < frames:
+            print("Spritesheet index out of range! " + spritesheet + ", " + str(frames - 1))
+
     def reset(self):
         self.index = 0
         self.timer = 0
@@ -165,32 +713,427 @@ class Animation():
                 self.index = 0
                 self.looped = True
 
-    def get_image(self):
-        return get_sprite(self.spritesheet, self.index, self.size)
+    def advance(self, time):
+        """
+        Moves the animation on by any amount of time at once and returns how many times it looped, for catching up
+        animations that weren't updated every step
+        """
+        self.timer += time
+        frames_passed = int(self.timer // self.frame_duration)
+        self.timer -= frames_passed * self.frame_duration
+        self.index += frames_passed
+        loops = self.index // self.frames
+        self.index %= self.frames
+        self.looped = loops > 0
+        return loops
+
+    def get_image(self, flip_x=False, flip_y=False):
+        return get_sprite(self.spritesheet, self.index, self.size, flip_x, flip_y)
+
+
+# Asset preloading, every image game() uses is decoded on a background thread while the menu is up
+ASSET_IMAGE = 0
+ASSET_SPRITESHEET = 1
+ASSET_BACKGROUND = 2
+GAME_ASSETS = [
+    (ASSET_BACKGROUND, "b_background", None),
+    (ASSET_IMAGE, "dialog", True),
+    (ASSET_IMAGE, "text-buttons", True),
+    (ASSET_IMAGE, "killbutton", True),
+    (ASSET_SPRITESHEET, "mouse-walk", (120, 160)),
+    (ASSET_SPRITESHEET, "mouse-front", (120, 160)),
+    (ASSET_SPRITESHEET, "mouse-back", (120, 160)),
+    (ASSET_SPRITESHEET, "bernard", (120, 160)),
+    (ASSET_SPRITESHEET, "bernard_cough", (120, 160)),
+    (ASSET_SPRITESHEET, "bird2", (160, 160)),
+    (ASSET_SPRITESHEET, "bird2_back", (160, 160)),
+    (ASSET_SPRITESHEET, "bird2_cough", (160, 160)),
+    (ASSET_SPRITESHEET, "birdblue", (130, 130)),
+    (ASSET_SPRITESHEET, "birdblue_cough", (130, 130)),
+    (ASSET_SPRITESHEET, "bunny", (100, 160)),
+    (ASSET_SPRITESHEET, "bunny_cough", (100, 160)),
+    (ASSET_SPRITESHEET, "bunny2", (80, 160)),
+    (ASSET_SPRITESHEET, "bunny2_cough", (80, 160)),
+    (ASSET_SPRITESHEET, "crook", (140, 160)),
+    (ASSET_SPRITESHEET, "crook_cough", (140, 160)),
+    (ASSET_SPRITESHEET, "dance", (140, 160)),
+    (ASSET_SPRITESHEET, "dance_cough", (140, 160)),
+    (ASSET_SPRITESHEET, "kitty", (140, 160)),
+    (ASSET_SPRITESHEET, "kitty_cough", (140, 160)),
+    (ASSET_SPRITESHEET, "rat", (120, 130)),
+    (ASSET_SPRITESHEET, "turtle", (100, 160)),
+    (ASSET_SPRITESHEET, "turtle_cough", (100, 160)),
+    (ASSET_SPRITESHEET, "trench_front", (120, 160)),
+    (ASSET_SPRITESHEET, "trench_back", (120, 160)),
+    (ASSET_SPRITESHEET, "trench_front_dizzy", (120, 160)),
+    (ASSET_SPRITESHEET, "trashcan", (140, 160)),
+    (ASSET_SPRITESHEET, "trashcan_cough", (140, 160)),
+    (ASSET_SPRITESHEET, "mouse2", (100, 130)),
+    (ASSET_SPRITESHEET, "mouse2_cough", (100, 130)),
+    (ASSET_SPRITESHEET, "mask", (120, 130)),
+    (ASSET_SPRITESHEET, "mask_angry", (120, 130)),
+]
+PRELOAD_BUDGET = 4 / SECOND  # Seconds per frame the main thread spends converting finished images
+
+
+class AssetPreloader():
+    """
+    Decodes PNGs on a worker thread, the main thread converts them and puts them into the image caches
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.finished = queue.Queue()
+        self.thread = None
+        self.installing = None
+        self.loaded = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.decode_all, daemon=True)
+            self.thread.start()
+
+    def decode_all(self):
+        for asset in self.manifest:
+            try:
+                image = read_image_file(asset[1])
+            except (pygame.error, OSError) as error:
+                # Left for get_image() to load, and fail loudly, on the main thread
+                print("Could not preload " + asset[1] + ": " + str(error))
+                image = None
+            if asset[0] == ASSET_BACKGROUND and image is not None:
+                image = split_into_tiles(image)
+            self.finished.put((asset, image))
+
+    def install(self, asset, image):
+        """
+        Converts a decoded asset and stores it in its cache, yields between each piece of work so that a large
+        background can be spread over several frames
+        """
+        kind, path, argument = asset
+        if kind == ASSET_BACKGROUND and image is not None:
+            for row in image:
+                for column in range(0, len(row)):
+                    row[column] = row[column].convert()
+                    yield
+            put_background_tiles(path, image)
+            return
+
+        if image is not None:
+            preloaded_images[path] = image
+        if kind == ASSET_BACKGROUND:
+            get_background_tiles(path)
+        elif kind == ASSET_SPRITESHEET:
+            get_sprite_frames(path, argument)
+        else:
+            get_image(path, argument)
+        yield
+
+    def pump(self, budget=PRELOAD_BUDGET):
+        """
+        Hands decoded images to the caches until the time budget runs out, always does at least one piece of work.
+        With no budget it waits for the worker and returns once everything is loaded
+        """
+        self.start()
+        start_time = time.perf_counter()
+        while not self.is_done():
+            if self.installing is None:
+                try:
+                    self.installing = self.install(*self.finished.get(budget is None))
+                except queue.Empty:
+                    return
+            if next(self.installing, False) is False:
+                self.installing = None
+                self.loaded += 1
+            if budget is not None and time.perf_counter() - start_time >= budget:
+                return
+
+    def get_progress(self):
+        return self.loaded / len(self.manifest)
+
+    def is_done(self):
+        return self.loaded == len(self.manifest)
+
+    def finish(self):
+        self.pump(None)
+
+
+asset_preloader = AssetPreloader(GAME_ASSETS)
+
+
+# Audio, music streams through pygame.mixer.music so a track is never decoded whole. Each track's file is read into
+# memory on a background thread ahead of time, switching tracks fades the current one out and the next one in
+MENU_MUSIC = "res/bgm/menu.mp3"
+INGAME_MUSIC = "res/bgm/ingame.mp3"
+MUSIC_TRACKS = [MENU_MUSIC, INGAME_MUSIC]
+SFX_CHANNELS = 8
+MUSIC_FADE_TIME = 1000
+
+
+class AudioPlayer():
+    """
+    Plays looping music tracks and pooled sound effects, does nothing if there is no audio device
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.tracks = {}
+        self.loading = set()
+        self.music_file = None
+        self.sounds = {}
+        self.sfx_channels = []
+        self.next_sfx_channel = 0
+        self.current_track = None
+        self.pending_track = None
+        self.pending_fade = 0
+
+    def start(self):
+        if pygame.mixer.get_init() is None:
+            print("No audio device found, sound is disabled")
+            return
+        self.enabled = True
+        pygame.mixer.set_num_channels(SFX_CHANNELS)
+        self.sfx_channels = [pygame.mixer.Channel(i) for i in range(0, SFX_CHANNELS)]
+
+    def preload(self, path):
+        """
+        Starts reading a music track into memory in the background so that switching to it doesn't wait on the disk
+        """
+        if not self.enabled or path in self.tracks or path in self.loading:
+            return
+        self.loading.add(path)
+        threading.Thread(target=self.read_track, args=(path,), daemon=True).start()
+
+    def read_track(self, path):
+        try:
+            with open(path, "rb") as track_file:
+                track = track_file.read()
+        except OSError as error:
+            print("Could not load " + path + ": " + str(error))
+            track = None
+        self.tracks[path] = track
+        self.loading.discard(path)
+
+    def play_music(self, path, fade_ms=MUSIC_FADE_TIME):
+        """
+        Fades out the current track and then fades in path, each over half of fade_ms. If path is still being read
+        it starts once it's ready
+        """
+        if not self.enabled:
+            return
+        self.preload(path)
+        if path == self.current_track and self.pending_track is None:
+            return
+        self.pending_track = path
+        self.pending_fade = fade_ms // 2
+        if pygame.mixer.music.get_busy():
+            pygame.mixer.music.fadeout(self.pending_fade)
+        self.update()
+
+    def stop_music(self, fade_ms=0):
+        self.pending_track = None
+        self.current_track = None
+        if not self.enabled:
+            return
+        if fade_ms > 0:
+            pygame.mixer.music.fadeout(fade_ms)
+        else:
+            pygame.mixer.music.stop()
+
+    def update(self):
+        # The next track waits until it has been read and the last one has faded out
+        if self.pending_track is None or self.pending_track not in self.tracks or pygame.mixer.music.get_busy():
+            return
+        track = self.tracks[self.pending_track]
+        if track is not None:
+            # The file object has to outlive playback, pygame.mixer.music reads from it as it plays
+            self.music_file = io.BytesIO(track)
+            pygame.mixer.music.load(self.music_file, os.path.splitext(self.pending_track)[1][1:])
+            pygame.mixer.music.play(loops=-1, fade_ms=self.pending_fade)
+        self.current_track = self.pending_track
+        self.pending_track = None
+
+    def play_sound(self, path, volume=1.0):
+        """
+        Plays a sound effect on a free channel from the pool, if every channel is busy the oldest one is reused
+        """
+        if len(self.sfx_channels) == 0:
+            return
+        if path not in self.sounds:
+            self.sounds[path] = pygame.mixer.Sound(path)
+        channel = None
+        for sfx_channel in self.sfx_channels:
+            if not sfx_channel.get_busy():
+                channel = sfx_channel
+                break
+        if channel is None:
+            # Channels are handed out in turn, so the next one in line has been playing the longest
+            channel = self.sfx_channels[self.next_sfx_channel]
+            self.next_sfx_channel = (self.next_sfx_channel + 1) % len(self.sfx_channels)
+        channel.set_volume(volume)
+        channel.play(self.sounds[path])
+
+
+audio = AudioPlayer()
+
+
+# Fonts, each one is loaded the first time it is used as an attribute of fonts, e.g. fonts.dialog
+FONTS = {
+    "small": ("Serif", 11, True),
+    "dialog": ("res/ttf/oxygen.ttf", 32, False),
+    "killbutton": ("res/ttf/oxygen.ttf", 28, False),
+    "prologue": ("res/ttf/oxygen.ttf", 26, False),
+    "title": ("res/ttf/Play-Regular.ttf", 72, False),
+}
+
+
+class FontLibrary():
+    def __getattr__(self, name):
+        if name not in FONTS:
+            raise AttributeError("No font named " + name)
+        path, size, system_font = FONTS[name]
+        if not pygame.font.get_init():
+            pygame.font.init()
+        if system_font:
+            font = pygame.font.SysFont(path, size)
+        else:
+            font = pygame.font.Font(path, size)
+        setattr(self, name, font)
+        return font
+
+
+fonts = FontLibrary()
+
+# Rendered text is kept in a bounded LRU cache since most strings are drawn again every frame
+TEXT_CACHE_SIZE = 256
+text_cache = collections.OrderedDict()
 
 
-# Fonts
-font_small = pygame.font.SysFont("Serif", 11)
-font_dialog = pygame.font.Font("res/ttf/oxygen.ttf", 32)
-font_killbutton = pygame.font.Font("res/ttf/oxygen.ttf", 28)
-font_prologue = pygame.font.Font("res/ttf/oxygen.ttf", 26)
-font_title = pygame.font.Font("res/ttf/Play-Regular.ttf", 72)
+def render_text(font, text, antialias, color):
+    key = (font, text, antialias, color)
+    if key in text_cache:
+        text_cache.move_to_end(key)
+        return text_cache[key]
 
+    text_surface = font.render(text, antialias, color)
+    text_cache[key] = text_surface
+    if len(text_cache) > TEXT_CACHE_SIZE:
+        text_cache.popitem(last=False)
 
-def split_dialog(dialog):
-    result_dialog = []
-    while len(dialog) > 52:
-        split_point = 52
-        if dialog[split_point - 1] != ' ' and dialog[split_point] != ' ':
-            split_point = dialog[:split_point].rfind(' ') + 1
-        result_dialog.append(dialog[:split_point])
-        dialog = dialog[split_point:]
-        if dialog[0] == ' ':
-            dialog = dialog[1:]
-    if dialog != "":
-        result_dialog.append(dialog)
+    return text_surface
+
+
+def wrap_text(font, text, width):
+    """
+    Splits text into lines no wider than width pixels, breaking between words and at newlines
+    """
+    lines = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in paragraph.split(" "):
+            if line == "":
+                line = word
+            elif font.size(line + " " + word)[0] > width:
+                lines.append(line)
+                line = word
+            else:
+                line += " " + word
+        lines.append(line)
+
+    return lines
+
+
+class TypewriterText():
+    """
+    Text that is typed out a character at a time. It's wrapped and each line rendered once when the text is set,
+    typing only moves a character offset and drawing shows each line's image up to that offset
+    """
+
+    def __init__(self, font, color, width, char_rate, lines_per_page=None):
+        self.font = font
+        self.color = color
+        self.width = width
+        self.char_rate = char_rate
+        self.lines_per_page = lines_per_page
+        self.set_text("")
+
+    def set_text(self, text):
+        self.lines = wrap_text(self.font, text, self.width)
+        self.images = [render_text(self.font, line, False, self.color) for line in self.lines]
+        # Pixel width of the first n characters of each line, and the character offset each line starts at. Every
+        # line ends with a break that takes as long to type as a character, so blank lines still make a pause
+        self.line_widths = [[self.font.size(line[:i])[0] for i in range(0, len(line) + 1)] for line in self.lines]
+        self.line_starts = [0]
+        for line in self.lines:
+            self.line_starts.append(self.line_starts[-1] + len(line) + 1)
+        self.page_start = 0
+        self.typed = 0
+        self.timer = 0
 
-    return result_dialog
+    def get_page_end(self):
+        if self.lines_per_page is None:
+            return len(self.lines)
+        return min(self.page_start + self.lines_per_page, len(self.lines))
+
+    def get_page_length(self):
+        # The break after the page's last line isn't typed
+        return max(self.line_starts[self.get_page_end()] - self.line_starts[self.page_start] - 1, 0)
+
+    def update(self, dt):
+        if self.typed < self.get_page_length():
+            self.timer += dt
+            if self.timer >= self.char_rate:
+                self.timer -= self.char_rate
+                self.typed += 1
+
+    def is_page_typed(self):
+        return self.typed >= self.get_page_length()
+
+    def has_next_page(self):
+        return self.get_page_end() < len(self.lines)
+
+    def is_done(self):
+        return self.is_page_typed() and not self.has_next_page()
+
+    def next_page(self):
+        self.page_start = self.get_page_end()
+        self.typed = 0
+
+    def skip(self):
+        """
+        Finishes typing the current paragraph, or the rest of the page if it comes first
+        """
+        typed_offset = self.line_starts[self.page_start] + self.typed
+        end_offset = self.line_starts[self.page_start] + self.get_page_length()
+        for i in range(self.page_start, self.get_page_end()):
+            if self.lines[i] == "" and self.line_starts[i] > typed_offset:
+                end_offset = self.line_starts[i]
+                break
+        self.typed = end_offset - self.line_starts[self.page_start]
+
+    def get_state(self):
+        return (self.page_start, self.typed)
+
+    def get_typed(self, line_index):
+        """
+        Returns how many characters of a line on the current page have been typed
+        """
+        typed_offset = self.line_starts[self.page_start] + self.typed
+        return max(min(typed_offset - self.line_starts[line_index], len(self.lines[line_index])), 0)
+
+    def get_line_rect(self, line_index, x, y, line_height, centered=False):
+        line_x = x
+        if centered:
+            line_x -= self.images[line_index].get_width() // 2
+        return (line_x, y + (line_height * (line_index - self.page_start)), self.images[line_index].get_width(), self.images[line_index].get_height())
+
+    def draw(self, x, y, line_height, centered=False):
+        typed_offset = self.line_starts[self.page_start] + self.typed
+        for i in range(self.page_start, self.get_page_end()):
+            if self.line_starts[i] >= typed_offset and self.lines[i] != "":
+                break
+            line_rect = self.get_line_rect(i, x, y, line_height, centered)
+            display.blit(self.images[i], line_rect[:2], (0, 0, self.line_widths[i][self.get_typed(i)], line_rect[3]))
 
 
 # game states
@@ -257,35 +1200,92 @@ def format_game_timer(game_timer):
 
 
 class Entity():
+    __slots__ = ("rotation", "offset_x", "offset_y", "_x", "_y", "previous_x", "previous_y", "width", "height", "vx", "vy", "hitbox_scale", "hitbox", "exact_hitbox", "hitbox_offset_x", "hitbox_offset_y", "hitbox_dirty")
+
     def __init__(self, size):
         self.rotation = None
         self.offset_x = 0
         self.offset_y = 0
-        self.x = 0
-        self.y = 0
         self.width, self.height = size
         self.vx = 0
         self.vy = 0
         self.hitbox_scale = 0.8
+        self.hitbox_offset_x = int(self.width * (1 - self.hitbox_scale))
+        self.hitbox_offset_y = int(self.height * (1 - self.hitbox_scale))
+        self.hitbox = pygame.Rect(0, 0, 0, 0)
+        self.exact_hitbox = [0, 0, int(self.width * self.hitbox_scale), int(self.height * self.hitbox_scale)]
+        self.hitbox_dirty = True
+        self.x = 0
+        self.y = 0
+        self.previous_x = 0
+        self.previous_y = 0
+
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = value
+        self.hitbox_dirty = True
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = value
+        self.hitbox_dirty = True
 
     def update(self, dt):
         self.x += self.vx * dt
         self.y += self.vy * dt
 
-    def get_x(self):
-        return int(round(self.x)) + self.offset_x
+    def save_position(self):
+        self.previous_x = self.x
+        self.previous_y = self.y
+
+    def get_x(self, interpolation=1):
+        return int(round(self.previous_x + ((self.x - self.previous_x) * interpolation))) + self.offset_x
 
-    def get_y(self):
-        return int(round(self.y)) + self.offset_y
+    def get_y(self, interpolation=1):
+        return int(round(self.previous_y + ((self.y - self.previous_y) * interpolation))) + self.offset_y
+
+    def move_hitbox(self, x, y):
+        """
+        Moves the exact hitbox to x, y and the whole pixel rect to the pixels it covers
+        """
+        left, top = x + self.hitbox_offset_x, y + self.hitbox_offset_y
+        self.exact_hitbox[0] = left
+        self.exact_hitbox[1] = top
+        self.hitbox.x, self.hitbox.y = math.floor(left), math.floor(top)
+        self.hitbox.width = math.ceil(left + self.exact_hitbox[2]) - self.hitbox.x
+        self.hitbox.height = math.ceil(top + self.exact_hitbox[3]) - self.hitbox.y
 
     def get_rect(self):
-        return (self.x + int(self.width * (1 - self.hitbox_scale)), self.y + int(self.height * (1 - self.hitbox_scale)), int(self.width * self.hitbox_scale), int(self.height * self.hitbox_scale))
+        """
+        Returns the whole pixel rect covering the hitbox, for the spatial grids and other broadphase checks. It is
+        only moved when x or y have changed since the last call. The rect is shared, so copy it before keeping it around
+        """
+        if self.hitbox_dirty:
+            self.move_hitbox(self._x, self._y)
+            self.hitbox_dirty = False
+        return self.hitbox
+
+    def get_hitbox(self):
+        """
+        Returns the hitbox at the entity's exact position as a shared [x, y, width, height] list, collisions are
+        tested against this so sub-pixel positions behave the same as they did with plain tuples
+        """
+        self.get_rect()
+        return self.exact_hitbox
 
     def get_center(self):
         return (self.x + self.width // 2, self.y + self.height // 2)
 
     def collides(self, other):
-        return rects_collide(self.get_rect(), other)
+        return rects_collide(self.get_hitbox(), other)
 
     def check_collision(self, dt, collider):
         """
@@ -323,12 +1323,453 @@ class Entity():
         return collides
 
 
+class NpcStore():
+    """
+    Keeps the movement state of every NPC in parallel numpy arrays so that it can all be updated in one pass
+    """
+
+    NO_PATROL = -1
+
+    def __init__(self, capacity=16):
+        self.count = 0
+        self.position = numpy.zeros((capacity, 2))
+        self.previous_position = numpy.zeros((capacity, 2))
+        self.velocity = numpy.zeros((capacity, 2))
+        self.hitbox_offset = numpy.zeros((capacity, 2))
+        self.hitbox_size = numpy.zeros((capacity, 2))
+        self.patrol_axis = numpy.full(capacity, NpcStore.NO_PATROL, dtype=numpy.int8)
+        self.patrol_min = numpy.zeros(capacity)
+        self.patrol_max = numpy.zeros(capacity)
+
+    def add(self):
+        if self.count == len(self.position):
+            for name in ("position", "previous_position", "velocity", "hitbox_offset", "hitbox_size", "patrol_axis", "patrol_min", "patrol_max"):
+                array = getattr(self, name)
+                grown_array = numpy.resize(array, (len(array) * 2,) + array.shape[1:])
+                grown_array[len(array):] = NpcStore.NO_PATROL if name == "patrol_axis" else 0
+                setattr(self, name, grown_array)
+
+        self.count += 1
+        return self.count - 1
+
+    def set_hitbox(self, index, size, hitbox_scale):
+        self.hitbox_offset[index] = (int(size[0] * (1 - hitbox_scale)), int(size[1] * (1 - hitbox_scale)))
+        self.hitbox_size[index] = (int(size[0] * hitbox_scale), int(size[1] * hitbox_scale))
+
+    def set_patrol(self, index, horizontal, start, end):
+        axis = 0 if horizontal else 1
+        self.patrol_axis[index] = axis
+        self.patrol_min[index] = start[axis]
+        self.patrol_max[index] = end[axis]
+
+    def save_positions(self):
+        self.previous_position[:self.count] = self.position[:self.count]
+
+    def get_mask(self, indices):
+        mask = numpy.zeros(self.count, dtype=bool)
+        mask[list(indices)] = True
+        return mask
+
+    def move(self, dt, indices, paused_index):
+        """
+        Moves the given NPCs except paused_index and returns the indices of the ones that moved
+        """
+        moving = self.get_mask(indices)
+        if paused_index >= 0:
+            moving[paused_index] = False
+        self.position[:self.count][moving] += self.velocity[:self.count][moving] * dt
+        return numpy.flatnonzero(moving)
+
+    def get_moving(self, indices):
+        """
+        Returns which of the given NPCs have a velocity, the only ones whose position can change
+        """
+        return numpy.flatnonzero(self.get_mask(indices) & numpy.any(self.velocity[:self.count] != 0, axis=1))
+
+    def get_colliding(self, indices, rect):
+        """
+        Returns which of the given NPCs have hitboxes that might overlap rect. Hitboxes are grown by a pixel
+        so that this stays a conservative broadphase for the exact hitbox test
+        """
+        hitbox_min = self.position[indices] + self.hitbox_offset[indices] - 1
+        hitbox_max = hitbox_min + self.hitbox_size[indices] + 2
+        overlaps = numpy.all((hitbox_min < (rect[0] + rect[2], rect[1] + rect[3])) & (hitbox_max > (rect[0], rect[1])), axis=1)
+        return indices[overlaps]
+
+    def update_patrols(self, indices):
+        """
+        Turns the given NPCs around if they patrol and reached either end of their route, and starts any that are
+        standing still
+        """
+        rows = numpy.flatnonzero(self.get_mask(indices) & (self.patrol_axis[:self.count] != NpcStore.NO_PATROL))
+        axes = self.patrol_axis[rows]
+        position = self.position[rows, axes]
+        velocity = self.velocity[rows, axes]
+
+        past_max = (velocity > 0) & (position >= self.patrol_max[rows])
+        past_min = (velocity < 0) & (position <= self.patrol_min[rows])
+        position = numpy.where(past_max, self.patrol_max[rows], numpy.where(past_min, self.patrol_min[rows], position))
+        velocity = numpy.where(past_max | past_min, -velocity, numpy.where(velocity == 0, 1, velocity))
+
+        self.position[rows, axes] = position
+        self.velocity[rows, axes] = velocity
+
+
+class NpcEntity(Entity):
+    """
+    An Entity whose position and velocity are stored in a row of an NpcStore
+    """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, size):
+        self.store = store
+        self.index = store.add()
+        Entity.__init__(self, size)
+        store.set_hitbox(self.index, size, self.hitbox_scale)
+
+    @property
+    def x(self):
+        return float(self.store.position[self.index, 0])
+
+    @x.setter
+    def x(self, value):
+        self.store.position[self.index, 0] = value
+
+    @property
+    def y(self):
+        return float(self.store.position[self.index, 1])
+
+    @y.setter
+    def y(self, value):
+        self.store.position[self.index, 1] = value
+
+    @property
+    def previous_x(self):
+        return float(self.store.previous_position[self.index, 0])
+
+    @previous_x.setter
+    def previous_x(self, value):
+        self.store.previous_position[self.index, 0] = value
+
+    @property
+    def previous_y(self):
+        return float(self.store.previous_position[self.index, 1])
+
+    @previous_y.setter
+    def previous_y(self, value):
+        self.store.previous_position[self.index, 1] = value
+
+    @property
+    def vx(self):
+        return float(self.store.velocity[self.index, 0])
+
+    @vx.setter
+    def vx(self, value):
+        self.store.velocity[self.index, 0] = value
+
+    @property
+    def vy(self):
+        return float(self.store.velocity[self.index, 1])
+
+    @vy.setter
+    def vy(self, value):
+        self.store.velocity[self.index, 1] = value
+
+    def get_rect(self):
+        # The store moves NPCs without going through the x/y setters, so the hitbox is always refreshed
+        self.move_hitbox(float(self.store.position[self.index, 0]), float(self.store.position[self.index, 1]))
+        return self.hitbox
+
+
+class SpatialGrid():
+    """
+    Buckets rects into square cells so that collision checks and picking only look at nearby objects
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.cell_ranges = {}
+
+    def get_cell_range(self, rect):
+        return (int(rect[0]) // self.cell_size, int(rect[1]) // self.cell_size, int(rect[0] + rect[2]) // self.cell_size, int(rect[1] + rect[3]) // self.cell_size)
+
+    def insert(self, key, rect):
+        cell_range = self.get_cell_range(rect)
+        self.cell_ranges[key] = cell_range
+        for cell_x in range(cell_range[0], cell_range[2] + 1):
+            for cell_y in range(cell_range[1], cell_range[3] + 1):
+                self.cells.setdefault((cell_x, cell_y), set()).add(key)
+
+    def remove(self, key):
+        cell_range = self.cell_ranges.pop(key)
+        for cell_x in range(cell_range[0], cell_range[2] + 1):
+            for cell_y in range(cell_range[1], cell_range[3] + 1):
+                self.cells[(cell_x, cell_y)].discard(key)
+
+    def move(self, key, rect):
+        # Most frames an entity stays inside the same cells, so there's nothing to update
+        if self.cell_ranges.get(key) != self.get_cell_range(rect):
+            if key in self.cell_ranges:
+                self.remove(key)
+            self.insert(key, rect)
+
+    def query(self, rect):
+        """
+        Returns the keys of everything sharing a cell with rect, in sorted order so results are stable between frames
+        """
+        cell_range = self.get_cell_range(rect)
+        keys = set()
+        for cell_x in range(cell_range[0], cell_range[2] + 1):
+            for cell_y in range(cell_range[1], cell_range[3] + 1):
+                cell = self.cells.get((cell_x, cell_y))
+                if cell:
+                    keys.update(cell)
+        return sorted(keys)
+
+
+def get_swept_rect(rect, x_step, y_step):
+    """
+    Returns a rect covering both rect and where rect was before moving by x_step, y_step
+    """
+    return (min(rect[0], rect[0] - x_step), min(rect[1], rect[1] - y_step), rect[2] + abs(x_step), rect[3] + abs(y_step))
+
+
+class DirtyRegions():
+    """
+    Tracks which parts of the display need to be redrawn. Each region is keyed and remembers the rect and state it
+    was last drawn with, and is only redrawn once either of those changes
+    """
+
+    def __init__(self):
+        self.regions = {}
+        self.rects = []
+        self.full = True
+
+    def update(self, key, rect, state):
+        rect = pygame.Rect(rect)
+        region = self.regions.get(key)
+        if region is None or region[0] != rect or region[1] != state:
+            if region is not None:
+                self.rects.append(region[0])
+            self.rects.append(rect)
+            self.regions[key] = (rect, state)
+
+    def reset(self):
+        """
+        Forgets every region so the next frame is drawn in full
+        """
+        self.regions = {}
+        self.rects = []
+        self.full = True
+
+    def take(self):
+        """
+        Returns the rects to redraw this frame, or None if the whole display needs to be redrawn
+        """
+        display_rect = display.get_rect()
+        rects = [rect.clip(display_rect) for rect in self.rects]
+        rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+        if self.full or sum(rect.width * rect.height for rect in rects) > (DISPLAY_WIDTH * DISPLAY_HEIGHT) // 2:
+            rects = None
+        self.rects = []
+        self.full = False
+        return rects
+
+
+# Render queue, lower layers are drawn first and within a layer things further down the screen are drawn on top
+LAYER_ENTITIES = 0
+
+
+class RenderCommand():
+    __slots__ = ("layer", "order", "sort_key", "image", "position")
+
+    def __init__(self, layer, order):
+        self.layer = layer
+        self.order = order
+        self.sort_key = (layer, 0, order)
+        self.image = None
+        self.position = (0, 0)
+
+
+class RenderQueue():
+    """
+    Holds a draw command for everything in the world and keeps them in depth order between frames. Depth barely
+    changes from one frame to the next, so the insertion sort that restores the order is close to a single pass.
+    Ties go to whatever was added first
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.commands_by_key = {}
+        self.added_count = 0
+
+    def add(self, key, layer):
+        command = RenderCommand(layer, self.added_count)
+        self.added_count += 1
+        self.commands.append(command)
+        self.commands_by_key[key] = command
+
+    def remove(self, key):
+        self.commands.remove(self.commands_by_key.pop(key))
+
+    def update(self, key, depth, image, position):
+        command = self.commands_by_key[key]
+        command.sort_key = (command.layer, depth, command.order)
+        command.image = image
+        command.position = position
+
+    def sort(self):
+        commands = self.commands
+        for i in range(1, len(commands)):
+            command = commands[i]
+            j = i - 1
+            while j >= 0 and commands[j].sort_key > command.sort_key:
+                commands[j + 1] = commands[j]
+                j -= 1
+            commands[j + 1] = command
+
+    def draw(self):
+        for command in self.commands:
+            display.blit(command.image, command.position)
+
+
+# Transitions, drawn over a state's frame by the compositor using surfaces that are only allocated once
+TRANSITION_NONE = 0
+TRANSITION_FADE = 1
+TRANSITION_CROSSFADE = 2
+FADE_DURATION = 40
+CROSSFADE_DURATION = 20
+
+
+class Compositor():
+    """
+    Keeps a snapshot of a finished frame and a black overlay the size of the display. Fading is done by changing
+    their alpha, a fade goes to black and back while a crossfade blends the snapshot into the new frame
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.overlay = None
+        self.transition = TRANSITION_NONE
+        self.timer = 0
+        self.duration = 1
+        self.drew_last_frame = False
+
+    def get_surfaces(self):
+        # The display changes size with the resolution, so the surfaces are made to match it when first needed
+        if self.snapshot is None or self.snapshot.get_size() != display.get_size():
+            self.snapshot = pygame.Surface(display.get_size()).convert()
+            self.overlay = pygame.Surface(display.get_size()).convert()
+            self.overlay.fill(BLACK)
+        return self.snapshot, self.overlay
+
+    def capture(self):
+        snapshot, overlay = self.get_surfaces()
+        snapshot.blit(display, (0, 0))
+
+    def draw_snapshot(self, alpha=255):
+        snapshot, overlay = self.get_surfaces()
+        self.draw_with_alpha(snapshot, alpha)
+
+    def draw_fade(self, alpha):
+        snapshot, overlay = self.get_surfaces()
+        self.draw_with_alpha(overlay, alpha)
+
+    def draw_with_alpha(self, surface, alpha):
+        alpha = int(max(min(alpha, 255), 0))
+        if alpha == 0:
+            return
+        # Blitting an opaque surface with an alpha of 255 takes a slow path, without any alpha it's a plain copy
+        if alpha == 255:
+            alpha = None
+        if surface.get_alpha() != alpha:
+            surface.set_alpha(alpha)
+        display.blit(surface, (0, 0))
+
+    def start_transition(self, transition):
+        """
+        Captures the current frame and starts transitioning from it to whatever is drawn next
+        """
+        self.capture()
+        self.transition = transition
+        self.timer = 0
+        self.duration = FADE_DURATION if transition == TRANSITION_FADE else CROSSFADE_DURATION
+
+    def is_active(self):
+        return self.transition != TRANSITION_NONE
+
+    def needs_full_redraw(self):
+        """
+        True while a transition is drawn over the frame and for the frame after it ends
+        """
+        return self.is_active() or self.drew_last_frame
+
+    def update(self, dt):
+        if self.transition != TRANSITION_NONE:
+            self.timer += dt
+            if self.timer >= self.duration:
+                self.transition = TRANSITION_NONE
+
+    def render(self):
+        self.drew_last_frame = self.is_active()
+        progress = self.timer / self.duration
+        if self.transition == TRANSITION_FADE:
+            if progress < 0.5:
+                self.draw_snapshot()
+                self.draw_fade(255 * progress * 2)
+            else:
+                self.draw_fade(255 * (1 - progress) * 2)
+        elif self.transition == TRANSITION_CROSSFADE:
+            self.draw_snapshot(255 * (1 - progress))
+
+
+compositor = Compositor()
+
+
+LOADING_BAR_HEIGHT = 4
+
+
+def render_loading_bar():
+    pygame.draw.rect(display, WHITE, (0, DISPLAY_HEIGHT - LOADING_BAR_HEIGHT, int(DISPLAY_WIDTH * asset_preloader.get_progress()), LOADING_BAR_HEIGHT))
+
+
+def load_game_assets():
+    """
+    Shows a loading screen until the preloader has every asset game() needs, usually it already does by the
+    time the prologue is over. The compositor keeps running so a fade into the loading screen doesn't freeze
+    """
+    loading_text = render_text(fonts.dialog, "Loading...", False, WHITE)
+    while not asset_preloader.is_done():
+        profiler.phase("input")
+        handle_input()
+
+        profiler.phase("update")
+        asset_preloader.pump()
+        for update_step in range(0, update_steps):
+            compositor.update(dt)
+
+        profiler.phase("render")
+        clear_display()
+        display.blit(loading_text, ((DISPLAY_WIDTH // 2) - (loading_text.get_width() // 2), (DISPLAY_HEIGHT // 2) - (loading_text.get_height() // 2)))
+        render_loading_bar()
+        compositor.render()
+
+        if show_fps:
+            render_profiler()
+        flip_display()
+        tick()
+
+
 def game():
+    global sync_entities
+
     running = True
     next_state = EXIT
 
-    pygame.mixer.music.load("res/bgm/ingame.mp3")
-    pygame.mixer.music.play(-1)
+    load_game_assets()
+
+    audio.play_music(INGAME_MUSIC)
 
     player = Entity((120, 160))
     player.x, player.y = (968, 3922)
@@ -339,18 +1780,15 @@ def game():
     most_recent_dx = 0
 
     disp_dialog = False
-    dialog_buffer = []
-    display_dialog_one = ""
-    display_dialog_two = ""
-    dialog_one = ""
-    dialog_two = ""
-    dialog_timer = 0
     dialog_char_rate = 4
+    # The dialog box is 1024 pixels wide and the text is inset 22 pixels on either side
+    dialog_text = TypewriterText(fonts.dialog, WHITE, 1024 - 44, dialog_char_rate, 2)
 
     dialog_index = -1
     dialog_questions = ["How are things in Bigtree?", "Have you been experiencing any symptoms?", "Do you know of anyone who's gotten sick lately?"]
     kill_prompt = False
 
+    npc_store = NpcStore()
     npcs = []
     npc_names = []
     npc_behaviors = []
@@ -363,7 +1801,7 @@ def game():
     cold_lines = []
     blame_lines = []
 
-    npcs.append(Entity((120, 160)))
+    npcs.append(NpcEntity(npc_store, (120, 160)))
     npcs[0].x, npcs[0].y = (2630, 2050)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("bernard", (120, 160), 3, 16))
@@ -376,7 +1814,7 @@ def game():
     cold_lines.append("Coughing fits come and go, but I believe it’s just a sore throat.")
     blame_lines.append("Hmm yes it seems NAME is down with something.")
 
-    npcs.append(Entity((160, 160)))
+    npcs.append(NpcEntity(npc_store, (160, 160)))
     npcs[1].x, npcs[1].y = (2840, 1620)
     npc_behaviors.append([False, 0.5, (npcs[1].x, npcs[1].y), (2840, 3500)])
     npc_animations.append(Animation("bird2", (160, 160), 2, 16))
@@ -389,7 +1827,7 @@ def game():
     cold_lines.append("SURE I’VE GOT A COUGH, BUT IT’S JUST A COLD! DON’T YOU BE GETTING ANY IDEAS!")
     blame_lines.append("YEAH I’D BET IT’S NAME! THEY’RE GETTING IN MY WAY EVEN MORE THAN USUAL!")
 
-    npcs.append(Entity((130, 130)))
+    npcs.append(NpcEntity(npc_store, (130, 130)))
     npcs[2].x, npcs[2].y = (850, 2800)
     npc_behaviors.append([True, 0.5, (npcs[2].x, npcs[2].y), (2000, 2800)])
     npc_animations.append(Animation("birdblue", (130, 130), 2, 16))
@@ -402,7 +1840,7 @@ def game():
     cold_lines.append("Just some normal stuff from the… supplements, I take.")
     blame_lines.append("NAME hasn’t really been the same recently.")
 
-    npcs.append(Entity((100, 160)))
+    npcs.append(NpcEntity(npc_store, (100, 160)))
     npcs[3].x, npcs[3].y = (3340, 2660)
     npc_behaviors.append([True, False])
     npc_animations.append(Animation("bunny", (100, 160), 3, 16))
@@ -415,7 +1853,7 @@ def game():
     cold_lines.append("That’s obviously why I’m trying to get a signal out. I’m home sick. Ha. No, no symptoms.")
     blame_lines.append("I have been getting mixed signals from NAME. Might just be a coincidence.")
 
-    npcs.append(Entity((80, 160)))
+    npcs.append(NpcEntity(npc_store, (80, 160)))
     npcs[4].x, npcs[4].y = (810, 1440)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("bunny2", (80, 160), 3, 16))
@@ -428,7 +1866,7 @@ def game():
     cold_lines.append("I’ve been sneezing more often, but I’ve been taking vitamins for it.")
     blame_lines.append("I have a hunch that it may be NAME, mister.")
 
-    npcs.append(Entity((140, 160)))
+    npcs.append(NpcEntity(npc_store, (140, 160)))
     npcs[5].x, npcs[5].y = (3350, 3600)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("crook", (140, 160), 13, 16))
@@ -441,7 +1879,7 @@ def game():
     cold_lines.append("Keheheh. don’t get any funny ideas, pal. This here’s just a light cough.")
     blame_lines.append("Yeah yeaah I know someone. You know NAME? Heard they’re not feelin’ too great. But you didn’t hear it from me, ya hear?")
 
-    npcs.append(Entity((140, 160)))
+    npcs.append(NpcEntity(npc_store, (140, 160)))
     npcs[6].x, npcs[6].y = (1725, 3010)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("dance", (140, 160), 4, 16))
@@ -454,7 +1892,7 @@ def game():
     cold_lines.append("I’ve been out of breath. The bucket has some mold that may be causing it, though.")
     blame_lines.append("NAME has been out of rhythm recently.")
 
-    npcs.append(Entity((140, 160)))
+    npcs.append(NpcEntity(npc_store, (140, 160)))
     npcs[7].x, npcs[7].y = (1680, 910)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("kitty", (140, 160), 4, 16))
@@ -467,7 +1905,7 @@ def game():
     cold_lines.append("Sneezing keeps waking me up from my cat nap. The shoe must be full of dust.")
     blame_lines.append("Lately, NAME has been almost as low energy as me.")
 
-    npcs.append(Entity((120, 130)))
+    npcs.append(NpcEntity(npc_store, (120, 130)))
     npcs[8].x, npcs[8].y = (630, 450)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("rat", (120, 130), 3, 16))
@@ -480,7 +1918,7 @@ def game():
     cold_lines.append("")
     blame_lines.append("Well I heard NAME c-c-coughing this morning. Might not mean anything though.")
 
-    npcs.append(Entity((100, 160)))
+    npcs.append(NpcEntity(npc_store, (100, 160)))
     npcs[9].x, npcs[9].y = (1470, 2340)
     npc_behaviors.append([True, 0.5, (npcs[9].x, npcs[9].y), (2410, 2340)])
     npc_animations.append(Animation("turtle", (100, 160), 3, 16))
@@ -493,7 +1931,7 @@ def game():
     cold_lines.append("A slight cough has recently interrupted my breathing techniques during training. Nothing but a cold thankfully.")
     blame_lines.append("That NAME seems to be hiding something.")
 
-    npcs.append(Entity((120, 160)))
+    npcs.append(NpcEntity(npc_store, (120, 160)))
     npcs[10].x, npcs[10].y = (620, 3080)
     npc_behaviors.append([False, 0.5, (npcs[10].x, npcs[10].y), (620, 3750)])
     npc_animations.append(Animation("trench_front", (120, 160), 4, 16))
@@ -506,7 +1944,7 @@ def game():
     cold_lines.append("*wheeze* I’m doing okay. Just a little lightheaded. Think I need to get a new mask.")
     blame_lines.append("Yeah I *wheeze* heard that NAME’s down with a cold.")
 
-    npcs.append(Entity((140, 160)))
+    npcs.append(NpcEntity(npc_store, (140, 160)))
     npcs[11].x, npcs[11].y = (3350, 70)
     npc_behaviors.append([False, False])
     npc_animations.append(Animation("trashcan", (140, 160), 42, 16))
@@ -519,7 +1957,7 @@ def game():
     cold_lines.append("*clears throat* kek kek, Oh look! A penny!")
     blame_lines.append("It has to be NAME, I saw ‘em throw away some empty med cases.")
 
-    npcs.append(Entity((100, 130)))
+    npcs.append(NpcEntity(npc_store, (100, 130)))
     npcs[12].x, npcs[12].y = (1790, 1320)
     npc_behaviors.append([True, 0.5, (npcs[12].x, npcs[12].y), (2530, 1320)])
     npc_animations.append(Animation("mouse2", (100, 130), 4, 16))
@@ -532,7 +1970,7 @@ def game():
     cold_lines.append("I'm going to need twice as many tissues today..")
     blame_lines.append("NAME has been grouchy lately, I should give them some space.")
 
-    npcs.append(Entity((120, 130)))
+    npcs.append(NpcEntity(npc_store, (120, 130)))
     npcs[13].x, npcs[13].y = (2140, 1130)
     npc_behaviors.append([True, 0.5, (npcs[13].x, npcs[13].y), (3240, 1130)])
     npc_animations.append(Animation("mask", (120, 130), 3, 16))
@@ -545,55 +1983,43 @@ def game():
     cold_lines.append("Having a stuffy nose makes wearing this mask hard, but nothing I can’t handle.")
     blame_lines.append("NAME has been buying lots of meds lately..hmm")
 
-    number_with_symptoms = 5
-    symptoms_npcs = []
-    for i in range(0, number_with_symptoms):
-        new_npc = random.randint(0, len(npcs) - 1)
-        while new_npc in symptoms_npcs or new_npc == 8:
-            new_npc = random.randint(0, len(npcs) - 1)
-        symptoms_npcs.append(new_npc)
-    sick_npc = symptoms_npcs[random.randint(0, number_with_symptoms - 1)]
-    number_with_blame = 7
-    blame_npcs = []
-    for i in range(0, number_with_blame):
-        new_npc = random.randint(0, len(npcs) - 1)
-        while new_npc in symptoms_npcs or new_npc in blame_npcs:
-            new_npc = random.randint(0, len(npcs) - 1)
-        blame_npcs.append(new_npc)
-    blame_pool = []
-    for i in range(0, (number_with_blame // 2)):
-        blame_pool.append(sick_npc)
-    while len(blame_pool) != number_with_blame:
-        possible_new = symptoms_npcs[random.randint(0, number_with_symptoms - 1)]
-        if possible_new not in blame_pool:
-            blame_pool.append(possible_new)
+    for i in range(0, len(npcs)):
+        if len(npc_behaviors[i]) == 4:
+            npc_store.set_patrol(i, npc_behaviors[i][0], npc_behaviors[i][2], npc_behaviors[i][3])
+
+    scenario = generate_scenario(random, len(npcs))
+    symptoms_npcs = scenario.symptoms
+    sick_npc = scenario.sick
     for i in range(0, len(npcs)):
         if i == sick_npc:
             npc_dialogs[i] = sick_dialogs[i]
         elif i in symptoms_npcs:
             npc_dialogs[i][2] = cold_lines[i]
-        elif i in blame_npcs:
-            blame_index = random.randint(0, len(blame_pool) - 1)
-            npc_dialogs[i][3] = blame_lines[i].replace("NAME", npc_names[blame_pool[blame_index]])
-            del blame_pool[blame_index]
+        elif i in scenario.blame:
+            npc_dialogs[i][3] = blame_lines[i].replace("NAME", npc_names[scenario.blame[i]])
     chosen_npc = -1
 
     success_message = "Well done. NAME had the virus, and though the town scorns you for their death, you know that you've prevented many more deaths through your actions."
     timeout_message = "Time's up! Discretion is important, but you needed move faster. Because of your delay, the virus spread to others and the contagion is now beyond your control."
     failed_message = "You have failed. NAME was a perfectly healthy individual, and you killed them on false pretenses. Perhaps you should have used more discretion in your investigation."
     failed_message_sick = "You have failed. While your guess was close, NAME merely had a common cold, and you killed them on false pretenses. Perhaps you should have used more discretion in your investigation."
-    end_message = ""
-    end_message_buffer = []
-    end_message_display = []
-    end_screen_surface = None
+    end_message_text = TypewriterText(fonts.dialog, WHITE, 1024 - 44, dialog_char_rate)
     fade_alpha = 0
     fade_alpha_inc_rate = 0
 
     camera_x, camera_y = (0, 0)
+    # The camera as of the last update step. Clicks, waking NPCs and the kill sequence go by it rather than the
+    # interpolated camera that's drawn with, so the simulation doesn't depend on how frames lined up with steps
+    sim_camera_x, sim_camera_y = (0, 0)
     screen_center = (DISPLAY_WIDTH // 2, DISPLAY_HEIGHT // 2)
     camera_offset_x, camera_offset_y = (player.width // 2) - screen_center[0], (player.height // 2) - screen_center[1]
     mouse_sensitivity = 0.1
 
+    def get_camera(player_interpolation):
+        x = player.get_x(player_interpolation) + camera_offset_x + int((mouse_x - screen_center[0]) * mouse_sensitivity)
+        y = player.get_y(player_interpolation) + camera_offset_y + int((mouse_y - screen_center[1]) * mouse_sensitivity)
+        return max(min(x, 4096 - DISPLAY_WIDTH), 0), max(min(y, 4096 - DISPLAY_HEIGHT), 0)
+
     map_colliders = []
     map_colliders.append((0, 0, 612, 4096))
     map_colliders.append((3478, 0, 618, 4096))
@@ -603,419 +2029,390 @@ def game():
     map_colliders.append((0, -1, 4096, 1))
     map_colliders.append((0, 4096, 4096, 1))
 
+    COLLISION_CELL_SIZE = 256
+    wall_grid = SpatialGrid(COLLISION_CELL_SIZE)
+    for i in range(0, len(map_colliders)):
+        wall_grid.insert(i, map_colliders[i])
+    npc_grid = SpatialGrid(COLLISION_CELL_SIZE)
+    for i in range(0, len(npcs)):
+        npc_grid.insert(i, npcs[i].get_rect())
+    sync_entities = [player] + npcs
+
     game_timer = 10 * (60 * 60)
 
-    while running:
-        # Handle input
-        handle_input()
-        while len(input_queue) != 0:
-            event = input_queue.pop()
-            if event == ("player up", True):
-                player_dy = -1
-            elif event == ("player right", True):
-                player_dx = 1
-            elif event == ("player down", True):
-                player_dy = 1
-            elif event == ("player left", True):
-                player_dx = -1
-            elif event == ("player up", False):
-                if input_states["player down"]:
-                    player_dy = 1
-                else:
-                    player_dy = 0
-            elif event == ("player right", False):
-                if input_states["player left"]:
-                    player_dx = -1
-                else:
-                    player_dx = 0
-            elif event == ("player down", False):
-                if input_states["player up"]:
-                    player_dy = -1
-                else:
-                    player_dy = 0
-            elif event == ("player left", False):
-                if input_states["player right"]:
-                    player_dx = 1
-                else:
-                    player_dx = 0
-            elif event == ("kill", True):
-                if not kill_prompt and disp_dialog and dialog_one == "" and dialog_two == "" and len(dialog_buffer) == 0:
-                    kill_prompt = True
-                    dialog_buffer = split_dialog("Are you sure you want to kill NAME?".replace("NAME", npc_names[dialog_index]))
-                    display_dialog_one = ""
-                    display_dialog_two = ""
-                    dialog_one = dialog_buffer[0]
-                    if len(dialog_buffer) > 1:
-                        dialog_two = dialog_buffer[1]
-                        dialog_buffer = dialog_buffer[2:]
-                    else:
-                        dialog_two = ""
-                        dialog_buffer = []
-            elif event == ("left click", True):
-                if chosen_npc != -1:
-                    text = font_dialog.render("Exit", False, WHITE)
-                    rect = (screen_center[0] - (text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.75) - 5, text.get_width() + 20, text.get_height() + 10)
-                    if point_in_rect((mouse_x, mouse_y), rect):
-                        next_state = MENU
-                        running = False
-                    continue
-                if disp_dialog:
-                    if dialog_one == "" and dialog_two == "":
-                        if len(dialog_buffer) == 0:
-                            if kill_prompt:
-                                for i in range(0, 2):
-                                    if point_in_rect((mouse_x, mouse_y), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60)):
-                                        if i == 0:
-                                            chosen_npc = dialog_index
-                                            if chosen_npc == sick_npc:
-                                                end_message_buffer = split_dialog(success_message.replace("NAME", npc_names[chosen_npc]))
-                                            else:
-                                                if chosen_npc in symptoms_npcs:
-                                                    end_message_buffer = split_dialog(failed_message_sick.replace("NAME", npc_names[chosen_npc]))
-                                                else:
-                                                    end_message_buffer = split_dialog(failed_message.replace("NAME", npc_names[chosen_npc]))
-                                            end_screen_surface = display.copy()
-                                            fade_alpha = 0
-                                            npc_target_x = screen_center[0] - (npcs[chosen_npc].width // 2) + camera_x
-                                            npc_target_y = screen_center[1] - (npcs[chosen_npc].height // 2) + camera_y
-                                            npc_x = npcs[chosen_npc].x
-                                            npc_y = npcs[chosen_npc].y
-                                            fade_alpha_inc_rate = 255 / (get_distance((npc_x, npc_y), (npc_target_x, npc_target_y)) / 3)
-                                        else:
-                                            kill_prompt = False
-                                            disp_dialog = False
-                                            display_dialog_one = ""
-                                            display_dialog_two = ""
-                                            dialog_one = ""
-                                            dialog_two = ""
-                                            dialog_buffer = []
-                                            dialog_index = -1
-                            else:
-                                clicked_dialog = False
-                                for i in range(0, len(dialog_questions)):
-                                    if point_in_rect((mouse_x, mouse_y), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60)):
-                                        dialog_buffer = split_dialog(npc_names[dialog_index] + ": " + npc_dialogs[dialog_index][i + 1])
-                                        display_dialog_one = ""
-                                        display_dialog_two = ""
-                                        dialog_one = dialog_buffer[0]
-                                        if len(dialog_buffer) > 1:
-                                            dialog_two = dialog_buffer[1]
-                                            dialog_buffer = dialog_buffer[2:]
+    # NPCs off screen sleep. They stop where they are, patrols included, and skip collision until they come back in
+    # range, their animations are caught up in one go. The margin covers how far the camera can move before the next
+    # step, so an NPC is always awake before it can be seen
+    NPC_WAKE_MARGIN = 256
+    awake_npcs = set()
+    npc_sleep_timers = [game_timer] * len(npcs)
+
+    def update_npc_animations(i, time):
+        """
+        Advances an NPC's animations and cough cycle by time, either one step or however long it was asleep
+        """
+        walking_back = len(npc_behaviors[i]) == 4 and not npc_behaviors[i][0] and npcs[i].vy < 0
+        if i in symptoms_npcs:
+            if walking_back:
+                npc_back_animations[i].advance(time)
+            elif npc_sick_counters[i] == 0:
+                if npc_sick_animations[i].advance(time) > 0:
+                    npc_sick_counters[i] = random.randint(1, 3)
+            else:
+                npc_sick_counters[i] = max(npc_sick_counters[i] - npc_animations[i].advance(time), 0)
+        if walking_back:
+            npc_back_animations[i].advance(time)
+        else:
+            npc_animations[i].advance(time)
+
+    player.save_position()
+    npc_store.save_positions()
+
+    def get_npc_image(i):
+        flip_x = False
+        flip_y = False
+        if len(npc_behaviors[i]) != 2:
+            if npc_behaviors[i][0]:
+                flip_x = npcs[i].vx < 0
+            else:
+                flip_y = npcs[i].vy < 0
+        else:
+            flip_x, flip_y = npc_behaviors[i]
+        if flip_y:
+            return npc_back_animations[i].get_image()
+        elif i in symptoms_npcs and npc_sick_counters[i] == 0:
+            return npc_sick_animations[i].get_image(flip_x, flip_y)
+        else:
+            return npc_animations[i].get_image(flip_x, flip_y)
+
+    render_queue = RenderQueue()
+    render_queue.add("player", LAYER_ENTITIES)
+    for i in range(0, len(npcs)):
+        render_queue.add(("npc", i), LAYER_ENTITIES)
+
+    def move_player(axis, direction, pressed, opposite_action):
+        """
+        Pressing a direction moves the player that way, releasing it goes back to the opposite direction if that's
+        still held
+        """
+        nonlocal player_dx, player_dy
+        if not pressed:
+            direction = -direction if input_states[opposite_action] else 0
+        if axis == 0:
+            player_dx = direction
+        else:
+            player_dy = direction
+
+    def on_kill():
+        nonlocal kill_prompt
+        if not kill_prompt and disp_dialog and dialog_text.is_done():
+            kill_prompt = True
+            dialog_text.set_text("Are you sure you want to kill NAME?".replace("NAME", npc_names[dialog_index]))
+
+    def on_click():
+        nonlocal running, next_state, chosen_npc, disp_dialog, dialog_index, kill_prompt, player_dx, player_dy
+        nonlocal fade_alpha, fade_alpha_inc_rate, npc_target_x, npc_target_y, npc_x, npc_y
+        if chosen_npc != -1:
+            text = render_text(fonts.dialog, "Exit", False, WHITE)
+            rect = (screen_center[0] - (text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.75) - 5, text.get_width() + 20, text.get_height() + 10)
+            if point_in_rect((mouse_x, mouse_y), rect):
+                next_state = MENU
+                running = False
+            return
+        if disp_dialog:
+            if dialog_text.is_page_typed():
+                if not dialog_text.has_next_page():
+                    if kill_prompt:
+                        for i in range(0, 2):
+                            if point_in_rect((mouse_x, mouse_y), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60)):
+                                if i == 0:
+                                    chosen_npc = dialog_index
+                                    if chosen_npc == sick_npc:
+                                        end_message_text.set_text(success_message.replace("NAME", npc_names[chosen_npc]))
+                                    else:
+                                        if chosen_npc in symptoms_npcs:
+                                            end_message_text.set_text(failed_message_sick.replace("NAME", npc_names[chosen_npc]))
                                         else:
-                                            dialog_two = ""
-                                            dialog_buffer = []
-                                        clicked_dialog = True
-                                        break
-                                if not clicked_dialog:
+                                            end_message_text.set_text(failed_message.replace("NAME", npc_names[chosen_npc]))
+                                    compositor.capture()
+                                    fade_alpha = 0
+                                    npc_target_x = screen_center[0] - (npcs[chosen_npc].width // 2) + sim_camera_x
+                                    npc_target_y = screen_center[1] - (npcs[chosen_npc].height // 2) + sim_camera_y
+                                    npc_x = npcs[chosen_npc].x
+                                    npc_y = npcs[chosen_npc].y
+                                    fade_alpha_inc_rate = 255 / (get_distance((npc_x, npc_y), (npc_target_x, npc_target_y)) / 3)
+                                else:
+                                    kill_prompt = False
                                     disp_dialog = False
+                                    dialog_text.set_text("")
                                     dialog_index = -1
-                        else:
-                            dialog_one = dialog_buffer[0]
-                            if len(dialog_buffer) > 1:
-                                dialog_two = dialog_buffer[1]
-                                dialog_buffer = dialog_buffer[2:]
-                            else:
-                                dialog_two = ""
-                                dialog_buffer = []
-                            display_dialog_one = ""
-                            display_dialog_two = ""
                     else:
-                        display_dialog_one += dialog_one
-                        display_dialog_two += dialog_two
-                        dialog_one = ""
-                        dialog_two = ""
-                else:
-                    for i in range(0, len(npcs)):
-                        if point_in_rect((mouse_x + camera_x, mouse_y + camera_y), npcs[i].get_rect()) and get_distance(player.get_center(), npcs[i].get_center()) <= 200:
-                            dialog_index = i
-                            if len(npc_behaviors[i]) == 4:
-                                npc_animations[dialog_index].reset()
-                                npc_sick_animations[dialog_index].reset()
-                            dialog = npc_names[dialog_index] + ": " + npc_dialogs[dialog_index][0]
-                            dialog_buffer = split_dialog(dialog)
-                            display_dialog_one = ""
-                            display_dialog_two = ""
-                            dialog_one = dialog_buffer[0]
-                            if len(dialog_buffer) > 1:
-                                dialog_two = dialog_buffer[1]
-                                dialog_buffer = dialog_buffer[2:]
-                            else:
-                                dialog_two = ""
-                                dialog_buffer = []
-                            disp_dialog = True
-                            player_dx, player_dy = (0, 0)
-
-        # Update
-        if chosen_npc == -1:
-            if disp_dialog:
-                if (player_dx, player_dy) != (0, 0):
-                    disp_dialog = False
-                    dialog_one = ""
-                    dialog_two = ""
-                    display_dialog_one = ""
-                    display_dialog_two = ""
-                    dialog_buffer = []
-                    dialog_index = -1
+                        clicked_dialog = False
+                        for i in range(0, len(dialog_questions)):
+                            if point_in_rect((mouse_x, mouse_y), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60)):
+                                dialog_text.set_text(npc_names[dialog_index] + ": " + npc_dialogs[dialog_index][i + 1])
+                                clicked_dialog = True
+                                break
+                        if not clicked_dialog:
+                            disp_dialog = False
+                            dialog_index = -1
                 else:
-                    if dialog_one != "":
-                        dialog_timer += dt
-                        if dialog_timer >= dialog_char_rate:
-                            dialog_timer -= dialog_char_rate
-                            display_dialog_one += dialog_one[0]
-                            dialog_one = dialog_one[1:]
-                    elif dialog_two != "":
-                        dialog_timer += dt
-                        if dialog_timer >= dialog_char_rate:
-                            dialog_timer -= dialog_char_rate
-                            display_dialog_two += dialog_two[0]
-                            dialog_two = dialog_two[1:]
-
-            # update player
-            if player_dx != 0:
-                most_recent_dx = player_dx
-            player.vx, player.vy = scale_vector((player_dx, player_dy), player_speed)
-            player.update(dt)
-            for collider in map_colliders:
-                player.check_collision(dt, collider)
-            for i in range(0, len(npcs)):
-                player.check_collision(dt, npcs[i].get_rect())
-            if (player.vx, player.vy) == (0, 0):
-                for animation in player_animation:
-                    animation.reset()
+                    dialog_text.next_page()
             else:
-                if player_animation_index == 0 and player_dx == 0:
-                    if player_dy == 1:
-                        player_animation_index = 1
-                    elif player_dy == -1:
-                        player_animation_index = 2
-                    player_animation[player_animation_index].reset()
-                elif (player_animation_index == 1 or player_animation_index == 2) and player_dx != 0:
-                    player_animation_index = 0
-                    player_animation[player_animation_index].reset()
-                elif player_animation_index == 1 and player_dx == 0:
-                    if player_dy == -1:
-                        player_animation_index = 2
-                        player_animation[player_animation_index].reset()
-                elif player_animation_index == 2 and player_dx == 0:
-                    if player_dy == 1:
-                        player_animation_index = 1
-                        player_animation[player_animation_index].reset()
-                player_animation[player_animation_index].update(dt)
+                dialog_text.skip()
+        else:
+            for i in npc_grid.query((mouse_x + sim_camera_x, mouse_y + sim_camera_y, 1, 1)):
+                if point_in_rect((mouse_x + sim_camera_x, mouse_y + sim_camera_y), npcs[i].get_hitbox()) and get_distance(player.get_center(), npcs[i].get_center()) <= 200:
+                    dialog_index = i
+                    if len(npc_behaviors[i]) == 4:
+                        npc_animations[dialog_index].reset()
+                        npc_sick_animations[dialog_index].reset()
+                    dialog_text.set_text(npc_names[dialog_index] + ": " + npc_dialogs[dialog_index][0])
+                    disp_dialog = True
+                    player_dx, player_dy = (0, 0)
+
+    input_handlers = {
+        ("player up", True): lambda: move_player(1, -1, True, "player down"),
+        ("player up", False): lambda: move_player(1, -1, False, "player down"),
+        ("player down", True): lambda: move_player(1, 1, True, "player up"),
+        ("player down", False): lambda: move_player(1, 1, False, "player up"),
+        ("player left", True): lambda: move_player(0, -1, True, "player right"),
+        ("player left", False): lambda: move_player(0, -1, False, "player right"),
+        ("player right", True): lambda: move_player(0, 1, True, "player left"),
+        ("player right", False): lambda: move_player(0, 1, False, "player left"),
+        ("kill", True): on_kill,
+        ("left click", True): on_click,
+    }
+
+    dirty_regions = DirtyRegions()
+    rendered_camera = None
 
-            for i in range(0, len(npcs)):
-                if i != dialog_index:
-                    npcs[i].update(dt)
-                    npcs[i].check_collision(dt, player.get_rect())
-                if not (i == dialog_index and len(npc_behaviors[i]) == 4):
-                    if i in symptoms_npcs:
-                        if len(npc_behaviors[i]) == 4 and not npc_behaviors[i][0] and npcs[i].vy < 0:
-                            npc_back_animations[i].update(dt)
-                        else:
-                            if npc_sick_counters[i] == 0:
-                                npc_sick_animations[i].update(dt)
-                                if npc_sick_animations[i].looped:
-                                    npc_sick_counters[i] = random.randint(1, 3)
-                            else:
-                                npc_animations[i].update(dt)
-                                if npc_animations[i].looped:
-                                    npc_sick_counters[i] -= 1
-                    if len(npc_behaviors[i]) == 4 and not npc_behaviors[i][0] and npcs[i].vy < 0:
-                        npc_back_animations[i].update(dt)
-                    else:
-                        npc_animations[i].update(dt)
-                if len(npc_behaviors[i]) != 2:
-                    if npc_behaviors[i][0]:
-                        if npcs[i].vx > 0:
-                            if npcs[i].x >= npc_behaviors[i][3][0]:
-                                npcs[i].x = npc_behaviors[i][3][0]
-                                npcs[i].vx *= -1
-                        elif npcs[i].vx < 0:
-                            if npcs[i].x <= npc_behaviors[i][2][0]:
-                                npcs[i].x = npc_behaviors[i][2][0]
-                                npcs[i].vx *= -1
-                        else:
-                            npcs[i].vx = 1
+    while running:
+        # Handle input
+        profiler.phase("input")
+        handle_input()
+        dispatch_input(input_handlers)
+
+        # Update, the simulation advances in fixed steps no matter how long the last frame took
+        profiler.phase("update")
+        for update_step in range(0, update_steps):
+            compositor.update(dt)
+            player.save_position()
+            npc_store.save_positions()
+
+            if chosen_npc == -1:
+                if disp_dialog:
+                    if (player_dx, player_dy) != (0, 0):
+                        disp_dialog = False
+                        dialog_text.set_text("")
+                        dialog_index = -1
                     else:
-                        if npcs[i].vy > 0:
-                            if npcs[i].y >= npc_behaviors[i][3][1]:
-                                npcs[i].y = npc_behaviors[i][3][1]
-                                npcs[i].vy *= -1
-                        elif npcs[i].vy < 0:
-                            if npcs[i].y <= npc_behaviors[i][2][1]:
-                                npcs[i].y = npc_behaviors[i][2][1]
-                                npcs[i].vy *= -1
-                        else:
-                            npcs[i].vy = 1
-
-            # update camera
-            if not disp_dialog:
-                camera_x, camera_y = player.get_x() + camera_offset_x + int((mouse_x - screen_center[0]) * mouse_sensitivity), player.get_y() + camera_offset_y + int((mouse_y - screen_center[1]) * mouse_sensitivity)
-                camera_x, camera_y = max(min(camera_x, 4096 - DISPLAY_WIDTH), 0), max(min(camera_y, 4096 - DISPLAY_HEIGHT), 0)
-
-            game_timer -= dt
-            if game_timer <= 0:
-                chosen_npc = -2
-                player_animation[0].reset()
-                end_message_buffer = split_dialog(timeout_message)
-                end_screen_surface = display.copy()
-                npc_target_x = screen_center[0] - (player.width // 2) + camera_x
-                npc_target_y = screen_center[1] - (player.height // 2) + camera_y
-                npc_x = player.x
-                npc_y = player.y
-                fade_alpha_inc_rate = 255 / (get_distance((npc_x, npc_y), (npc_target_x, npc_target_y)) / 3)
-        else:
-            npc_target_x = 0
-            npc_target_y = 0
-            npc_x = 0
-            npc_y = 0
-            if chosen_npc == -2:
-                npc_target_x = screen_center[0] - (player.width // 2) + camera_x
-                npc_target_y = screen_center[1] - (player.height // 2) + camera_y
-                npc_x = player.x
-                npc_y = player.y
+                        dialog_text.update(dt)
+
+                # update player
+                if player_dx != 0:
+                    most_recent_dx = player_dx
+                player.vx, player.vy = scale_vector((player_dx, player_dy), player_speed)
+                player.update(dt)
+                profiler.phase("collision")
+                player_swept_rect = get_swept_rect(player.get_rect(), player.vx * dt, player.vy * dt)
+                for i in wall_grid.query(player_swept_rect):
+                    player.check_collision(dt, map_colliders[i])
+                for i in npc_grid.query(player_swept_rect):
+                    player.check_collision(dt, npcs[i].get_hitbox())
+                profiler.phase("update")
+                if (player.vx, player.vy) == (0, 0):
+                    for animation in player_animation:
+                        animation.reset()
+                else:
+                    if player_animation_index == 0 and player_dx == 0:
+                        if player_dy == 1:
+                            player_animation_index = 1
+                        elif player_dy == -1:
+                            player_animation_index = 2
+                        player_animation[player_animation_index].reset()
+                    elif (player_animation_index == 1 or player_animation_index == 2) and player_dx != 0:
+                        player_animation_index = 0
+                        player_animation[player_animation_index].reset()
+                    elif player_animation_index == 1 and player_dx == 0:
+                        if player_dy == -1:
+                            player_animation_index = 2
+                            player_animation[player_animation_index].reset()
+                    elif player_animation_index == 2 and player_dx == 0:
+                        if player_dy == 1:
+                            player_animation_index = 1
+                            player_animation[player_animation_index].reset()
+                    player_animation[player_animation_index].update(dt)
+
+                profiler.phase("npcs")
+                moved_npcs = npc_store.move(dt, awake_npcs, dialog_index)
+                profiler.phase("collision")
+                for i in npc_store.get_colliding(moved_npcs, player.get_rect()):
+                    npcs[i].check_collision(dt, player.get_hitbox())
+                profiler.phase("npcs")
+                # Wake the NPCs that could be on screen and put the rest to sleep. This goes by the camera rather than
+                # the player, near the edges of the map the camera is clamped and no longer centred on them
+                wake_rect = (sim_camera_x - NPC_WAKE_MARGIN, sim_camera_y - NPC_WAKE_MARGIN, DISPLAY_WIDTH + (2 * NPC_WAKE_MARGIN), DISPLAY_HEIGHT + (2 * NPC_WAKE_MARGIN))
+                nearby_npcs = npc_grid.query(wake_rect)
+                for i in awake_npcs.difference(nearby_npcs):
+                    npc_sleep_timers[i] = game_timer
+                for i in nearby_npcs:
+                    if i not in awake_npcs and npc_sleep_timers[i] != game_timer:
+                        update_npc_animations(i, npc_sleep_timers[i] - game_timer)
+                awake_npcs = set(nearby_npcs)
+                for i in nearby_npcs:
+                    if not (i == dialog_index and len(npc_behaviors[i]) == 4):
+                        update_npc_animations(i, dt)
+                npc_store.update_patrols(awake_npcs)
+                for i in npc_store.get_moving(awake_npcs).tolist():
+                    npc_grid.move(i, npcs[i].get_rect())
+                profiler.phase("update")
+
+                game_timer -= dt
+                if game_timer <= 0:
+                    chosen_npc = -2
+                    player_animation[0].reset()
+                    end_message_text.set_text(timeout_message)
+                    compositor.capture()
+                    npc_target_x = screen_center[0] - (player.width // 2) + sim_camera_x
+                    npc_target_y = screen_center[1] - (player.height // 2) + sim_camera_y
+                    npc_x = player.x
+                    npc_y = player.y
+                    fade_alpha_inc_rate = 255 / (get_distance((npc_x, npc_y), (npc_target_x, npc_target_y)) / 3)
             else:
-                npc_target_x = screen_center[0] - (npcs[chosen_npc].width // 2) + camera_x
-                npc_target_y = screen_center[1] - (npcs[chosen_npc].height // 2) + camera_y
-                npc_x = npcs[chosen_npc].x
-                npc_y = npcs[chosen_npc].y
-            if get_distance((npc_x, npc_y), (npc_target_x, npc_target_y)) <= 10:
+                npc_target_x = 0
+                npc_target_y = 0
+                npc_x = 0
+                npc_y = 0
                 if chosen_npc == -2:
-                    player.x = npc_target_x
-                    player.y = npc_target_y
+                    npc_target_x = screen_center[0] - (player.width // 2) + sim_camera_x
+                    npc_target_y = screen_center[1] - (player.height // 2) + sim_camera_y
                     npc_x = player.x
                     npc_y = player.y
                 else:
-                    npcs[chosen_npc].x = npc_target_x
-                    npcs[chosen_npc].y = npc_target_y
+                    npc_target_x = screen_center[0] - (npcs[chosen_npc].width // 2) + sim_camera_x
+                    npc_target_y = screen_center[1] - (npcs[chosen_npc].height // 2) + sim_camera_y
                     npc_x = npcs[chosen_npc].x
                     npc_y = npcs[chosen_npc].y
-                fade_alpha = 255
-            if npc_x != npc_target_x or npc_y != npc_target_y:
-                distance_vector = (npc_target_x - npc_x, npc_target_y - npc_y)
-                move_speed = 3
-                if chosen_npc == -2:
-                    player.vx, player.vy = scale_vector(distance_vector, move_speed)
-                    player.update(dt)
+                if get_distance((npc_x, npc_y), (npc_target_x, npc_target_y)) <= 10:
+                    if chosen_npc == -2:
+                        player.x = npc_target_x
+                        player.y = npc_target_y
+                        npc_x = player.x
+                        npc_y = player.y
+                    else:
+                        npcs[chosen_npc].x = npc_target_x
+                        npcs[chosen_npc].y = npc_target_y
+                        npc_x = npcs[chosen_npc].x
+                        npc_y = npcs[chosen_npc].y
+                    fade_alpha = 255
+                if npc_x != npc_target_x or npc_y != npc_target_y:
+                    distance_vector = (npc_target_x - npc_x, npc_target_y - npc_y)
+                    move_speed = 3
+                    if chosen_npc == -2:
+                        player.vx, player.vy = scale_vector(distance_vector, move_speed)
+                        player.update(dt)
+                    else:
+                        npcs[chosen_npc].vx, npcs[chosen_npc].vy = scale_vector(distance_vector, move_speed)
+                        npcs[chosen_npc].update(dt)
+                    fade_alpha += fade_alpha_inc_rate
                 else:
-                    npcs[chosen_npc].vx, npcs[chosen_npc].vy = scale_vector(distance_vector, move_speed)
-                    npcs[chosen_npc].update(dt)
-                fade_alpha += fade_alpha_inc_rate
-            else:
-                if len(end_message_buffer) != 0 or end_message != "":
-                    if end_message == "":
-                        end_message = end_message_buffer[0]
-                        end_message_buffer = end_message_buffer[1:]
-                        end_message_display.append("")
-                    dialog_timer += dt
-                    if dialog_timer >= dialog_char_rate:
-                        dialog_timer -= dialog_char_rate
-                        end_message_display[len(end_message_display) - 1] += end_message[0]
-                        end_message = end_message[1:]
+                    end_message_text.update(dt)
+
+        # Update camera, it's drawn from the interpolated player position. Once it stops following the player it
+        # settles on the simulation's camera, which the kill sequence centres things by
+        if chosen_npc == -1 and not disp_dialog:
+            sim_camera_x, sim_camera_y = get_camera(1)
+            camera_x, camera_y = get_camera(interpolation)
+        else:
+            camera_x, camera_y = sim_camera_x, sim_camera_y
 
         # Render
-        clear_display()
+        profiler.phase("render")
+
+        # While talking to someone the camera is still, so only the parts of the screen that changed get redrawn
+        if chosen_npc == -1 and disp_dialog and not show_fps and not compositor.needs_full_redraw() and (camera_x, camera_y) == rendered_camera:
+            for i in range(0, len(npcs)):
+                dirty_regions.update(("npc", i), (npcs[i].get_x(interpolation) - camera_x, npcs[i].get_y(interpolation) - camera_y, npcs[i].width, npcs[i].height), get_npc_image(i))
+            dirty_regions.update("player", (player.get_x(interpolation) - camera_x, player.get_y(interpolation) - camera_y, player.width, player.height), player_animation[player_animation_index].get_image(most_recent_dx < 0 and player_animation_index == 0, False))
+            dirty_regions.update("dialog", (int(1280 * 0.1), 0, int(1280 * 0.8), 120), dialog_text.get_state())
+            dirty_regions.update("options", (int(1280 * 0.1), DISPLAY_HEIGHT - 250 - 70, int(1280 * 0.8), 270), (dialog_text.is_done(), kill_prompt))
+            dirty_regions.update("timer", render_text(fonts.dialog, format_game_timer(game_timer), False, YELLOW).get_rect(), (format_game_timer(game_timer), game_timer <= 3600))
+        else:
+            dirty_regions.reset()
+        rendered_camera = (camera_x, camera_y)
+        dirty_rects = dirty_regions.take()
 
         if chosen_npc == -1:
-            display.blit(get_image("background_scaled", False), (0 - camera_x, 0 - camera_y))
-            draw_before_npcs = []
-            draw_after_npcs = []
+            render_queue.update("player", player.y, player_animation[player_animation_index].get_image(most_recent_dx < 0 and player_animation_index == 0, False), (player.get_x(interpolation) - camera_x, player.get_y(interpolation) - camera_y))
             for i in range(0, len(npcs)):
-                if npcs[i].y < player.y:
-                    draw_before_npcs.append(i)
-                else:
-                    draw_after_npcs.append(i)
-            for i in draw_before_npcs:
-                flip_x = False
-                flip_y = False
-                if len(npc_behaviors[i]) != 2:
-                    if npc_behaviors[i][0]:
-                        flip_x = npcs[i].vx < 0
-                    else:
-                        flip_y = npcs[i].vy < 0
-                else:
-                    flip_x, flip_y = npc_behaviors[i]
-                if flip_y:
-                    display.blit(npc_back_animations[i].get_image(), (npcs[i].get_x() - camera_x, npcs[i].get_y() - camera_y))
-                elif i in symptoms_npcs and npc_sick_counters[i] == 0:
-                    display.blit(pygame.transform.flip(npc_sick_animations[i].get_image(), flip_x, flip_y), (npcs[i].get_x() - camera_x, npcs[i].get_y() - camera_y))
-                else:
-                    display.blit(pygame.transform.flip(npc_animations[i].get_image(), flip_x, flip_y), (npcs[i].get_x() - camera_x, npcs[i].get_y() - camera_y))
-            display.blit(pygame.transform.flip(player_animation[player_animation_index].get_image(), most_recent_dx < 0 and player_animation_index == 0, False), (player.get_x() - camera_x, player.get_y() - camera_y))
-            for i in draw_after_npcs:
-                flip_x = False
-                flip_y = False
-                if len(npc_behaviors[i]) != 2:
-                    if npc_behaviors[i][0]:
-                        flip_x = npcs[i].vx < 0
-                    else:
-                        flip_y = npcs[i].vy < 0
-                else:
-                    flip_x, flip_y = npc_behaviors[i]
-                if flip_y:
-                    display.blit(npc_back_animations[i].get_image(), (npcs[i].get_x() - camera_x, npcs[i].get_y() - camera_y))
-                elif i in symptoms_npcs and npc_sick_counters[i] == 0:
-                    display.blit(pygame.transform.flip(npc_sick_animations[i].get_image(), flip_x, flip_y), (npcs[i].get_x() - camera_x, npcs[i].get_y() - camera_y))
-                else:
-                    display.blit(pygame.transform.flip(npc_animations[i].get_image(), flip_x, flip_y), (npcs[i].get_x() - camera_x, npcs[i].get_y() - camera_y))
+                render_queue.update(("npc", i), npcs[i].y, get_npc_image(i), (npcs[i].get_x(interpolation) - camera_x, npcs[i].get_y(interpolation) - camera_y))
+            render_queue.sort()
 
-            if disp_dialog:
-                # pygame.draw.rect(display, BLUE, (int(1280 * 0.1), 0, int(1280 * 0.8), 120))
-                display.blit(get_image("dialog", True), (int(1280 * 0.1), 0))
-                text_one = font_dialog.render(display_dialog_one, False, WHITE)
-                text_two = font_dialog.render(display_dialog_two, False, WHITE)
-                display.blit(text_one, (int(1280 * 0.1) + 22, 17))
-                display.blit(text_two, (int(1280 * 0.1) + 22, 57))
+        for clip_rect in ([None] if dirty_rects is None else dirty_rects):
+            display.set_clip(clip_rect)
+            clear_display()
 
-                if dialog_one == "" and dialog_two == ""and len(dialog_buffer) == 0:
-                    if kill_prompt:
-                        kill_prompt_questions = ["Yes", "No"]
-                        for i in range(0, len(kill_prompt_questions)):
-                            # pygame.draw.rect(display, RED, (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60))
-                            display.blit(get_image("text-buttons", True), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i)))
-                            text = font_dialog.render(kill_prompt_questions[i], False, WHITE)
-                            display.blit(text, (int(1280 * 0.1) + 22, DISPLAY_HEIGHT - 250 + (70 * i) + 10))
-                    else:
-                        # pygame.draw.rect(display, RED, (int(1280 * 0.65), DISPLAY_HEIGHT - 250 - 70, int(1280 * 0.25), 60))
-                        display.blit(get_image("killbutton", True), (int(1280 * 0.65), DISPLAY_HEIGHT - 250 - 70))
-                        text = font_killbutton.render("Press X to Kill", False, WHITE)
-                        display.blit(text, (int(1280 * 0.65) + 50, DISPLAY_HEIGHT - 250 - 70 + 10))
-                        for i in range(0, len(dialog_questions)):
-                            # pygame.draw.rect(display, BLUE, (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60))
-                            display.blit(get_image("text-buttons", True), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i)))
-                            text = font_dialog.render(dialog_questions[i], False, WHITE)
-                            display.blit(text, (int(1280 * 0.1) + 22, DISPLAY_HEIGHT - 250 + (70 * i) + 10))
-
-            timer_color = YELLOW
-            if game_timer <= 3600:
-                timer_color = RED
-            text = font_dialog.render(format_game_timer(game_timer), False, timer_color)
-            display.blit(text, (0, 0))
-        else:
-            if fade_alpha < 255:
-                display.blit(end_screen_surface, (0, 0))
-                fade_surface = pygame.Surface((DISPLAY_WIDTH, DISPLAY_HEIGHT), pygame.SRCALPHA)
-                fade_surface.fill((0, 0, 0, fade_alpha))
-                display.blit(fade_surface, (0, 0))
-            if chosen_npc == -2:
-                display.blit(player_animation[0].get_image(), (player.get_x() - camera_x, player.get_y() - camera_y))
+            if chosen_npc == -1:
+                profiler.phase("background")
+                render_background("b_background", camera_x, camera_y)
+                profiler.phase("render")
+                render_queue.draw()
+
+                if disp_dialog:
+                    # pygame.draw.rect(display, BLUE, (int(1280 * 0.1), 0, int(1280 * 0.8), 120))
+                    display.blit(get_image("dialog", True), (int(1280 * 0.1), 0))
+                    dialog_text.draw(int(1280 * 0.1) + 22, 17, 40)
+
+                    if dialog_text.is_done():
+                        if kill_prompt:
+                            kill_prompt_questions = ["Yes", "No"]
+                            for i in range(0, len(kill_prompt_questions)):
+                                # pygame.draw.rect(display, RED, (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60))
+                                display.blit(get_image("text-buttons", True), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i)))
+                                text = render_text(fonts.dialog, kill_prompt_questions[i], False, WHITE)
+                                display.blit(text, (int(1280 * 0.1) + 22, DISPLAY_HEIGHT - 250 + (70 * i) + 10))
+                        else:
+                            # pygame.draw.rect(display, RED, (int(1280 * 0.65), DISPLAY_HEIGHT - 250 - 70, int(1280 * 0.25), 60))
+                            display.blit(get_image("killbutton", True), (int(1280 * 0.65), DISPLAY_HEIGHT - 250 - 70))
+                            text = render_text(fonts.killbutton, "Press X to Kill", False, WHITE)
+                            display.blit(text, (int(1280 * 0.65) + 50, DISPLAY_HEIGHT - 250 - 70 + 10))
+                            for i in range(0, len(dialog_questions)):
+                                # pygame.draw.rect(display, BLUE, (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i), int(1280 * 0.8), 60))
+                                display.blit(get_image("text-buttons", True), (int(1280 * 0.1), DISPLAY_HEIGHT - 250 + (70 * i)))
+                                text = render_text(fonts.dialog, dialog_questions[i], False, WHITE)
+                                display.blit(text, (int(1280 * 0.1) + 22, DISPLAY_HEIGHT - 250 + (70 * i) + 10))
+
+                timer_color = YELLOW
+                if game_timer <= 3600:
+                    timer_color = RED
+                text = render_text(fonts.dialog, format_game_timer(game_timer), False, timer_color)
+                display.blit(text, (0, 0))
             else:
-                display.blit(npc_animations[chosen_npc].get_image(), (npcs[chosen_npc].get_x() - camera_x, npcs[chosen_npc].get_y() - camera_y))
-            for i in range(0, len(end_message_display)):
-                text = font_dialog.render(end_message_display[i], False, WHITE)
-                display.blit(text, (screen_center[0] - (text.get_width() // 2), 60 + (40 * i)))
-            if len(end_message_buffer) == 0 and end_message == "":
-                text = font_dialog.render("Exit", False, WHITE)
-                rect = (screen_center[0] - (text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.75) - 5, text.get_width() + 20, text.get_height() + 10)
-                display.blit(text, (screen_center[0] - (text.get_width() // 2), int(DISPLAY_HEIGHT * 0.75)))
-                pygame.draw.rect(display, WHITE, rect, not point_in_rect((mouse_x, mouse_y), rect))
+                if fade_alpha < 255:
+                    compositor.draw_snapshot()
+                    compositor.draw_fade(fade_alpha)
+                if chosen_npc == -2:
+                    display.blit(player_animation[0].get_image(), (player.get_x(interpolation) - camera_x, player.get_y(interpolation) - camera_y))
+                else:
+                    display.blit(npc_animations[chosen_npc].get_image(), (npcs[chosen_npc].get_x(interpolation) - camera_x, npcs[chosen_npc].get_y(interpolation) - camera_y))
+                end_message_text.draw(screen_center[0], 60, 40, True)
+                if end_message_text.is_done():
+                    text = render_text(fonts.dialog, "Exit", False, WHITE)
+                    rect = (screen_center[0] - (text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.75) - 5, text.get_width() + 20, text.get_height() + 10)
+                    display.blit(text, (screen_center[0] - (text.get_width() // 2), int(DISPLAY_HEIGHT * 0.75)))
+                    pygame.draw.rect(display, WHITE, rect, not point_in_rect((mouse_x, mouse_y), rect))
+
+        display.set_clip(None)
+        compositor.render()
 
         if show_fps:
-            render_fps()
-        flip_display()
+            render_profiler()
+        flip_display(dirty_rects)
         tick()
 
-    pygame.mixer.music.stop()
     if next_state == MENU:
+        compositor.start_transition(TRANSITION_FADE)
         menu()
 
 
@@ -1023,8 +2420,7 @@ def menu():
     running = True
     next_state = EXIT
 
-    pygame.mixer.music.load("res/bgm/menu.mp3")
-    pygame.mixer.music.play(-1)
+    audio.play_music(MENU_MUSIC)
 
     TITLE = 0
     PROLOGUE = 1
@@ -1032,176 +2428,308 @@ def menu():
 
     screen_center = (DISPLAY_WIDTH // 2, DISPLAY_HEIGHT // 2)
 
-    title_text = font_title.render("Critter Contagion", False, WHITE)
-    play_text = font_dialog.render("Play", False, WHITE)
+    title_text = render_text(fonts.title, "Critter Contagion", False, WHITE)
+    play_text = render_text(fonts.dialog, "Play", False, WHITE)
     play_rect = (screen_center[0] - (play_text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.55) - 5, play_text.get_width() + 20, play_text.get_height() + 10)
-    exit_text = font_dialog.render("Exit", False, WHITE)
+    exit_text = render_text(fonts.dialog, "Exit", False, WHITE)
     exit_rect = (screen_center[0] - (exit_text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.55) - 5 + 80, exit_text.get_width() + 20, exit_text.get_height() + 10)
 
-    dialog_timer = 0
     dialog_char_rate = 2
-    dialog_display = []
-    current_line = ""
+    prologue = TypewriterText(fonts.prologue, WHITE, int(DISPLAY_WIDTH * 0.65), dialog_char_rate)
 
-    prologue = []
     prologue_text = "Panic sweeps the critter population as a deadly virus spreads from rodent to rodent. "
-    prologue_text += "The Axeman Virus has no cure; only death can prevent its further spread among the population. "
-    prologue.append(split_dialog(prologue_text) + [" "])
-    prologue_text = "Faced with the end of the world, the Whisker's Health Organization fights a desperate struggle "
+    prologue_text += "The Axeman Virus has no cure; only death can prevent its further spread among the population.\n\n"
+    prologue_text += "Faced with the end of the world, the Whisker's Health Organization fights a desperate struggle "
     prologue_text += "against an unstoppable plague and a rising death rate. "
     prologue_text += "Reports tell of an infected individual who has made their way to the city of Bigtree. "
-    prologue_text += "To prevent further spread of the disease, the WHO has sent you to take this individual out. "
-    prologue.append(split_dialog(prologue_text) + [" "])
-    prologue_text = "Here, discretion is key. Individuals aren't likely to be forthcoming about their condition, "
+    prologue_text += "To prevent further spread of the disease, the WHO has sent you to take this individual out.\n\n"
+    prologue_text += "Here, discretion is key. Individuals aren't likely to be forthcoming about their condition, "
     prologue_text += "and the visible symptoms of the disease are the same as those of a common cold. But a wrong "
     prologue_text += "decision would mean the needless death of innocents, and the disease waits for no one."
-    prologue.append(split_dialog(prologue_text) + [" "])
+    prologue.set_text(prologue_text)
 
     prologue_play_rect = (screen_center[0] - (play_text.get_width() // 2) - 10, int(DISPLAY_HEIGHT * 0.87) - 5, play_text.get_width() + 20, play_text.get_height() + 10)
 
-    while running:
-        handle_input()
-        while len(input_queue) != 0:
-            event = input_queue.pop()
-            if event == ("left click", True):
-                if menu_state == TITLE:
-                    if point_in_rect((mouse_x, mouse_y), play_rect):
-                        menu_state = PROLOGUE
-                    elif point_in_rect((mouse_x, mouse_y), exit_rect):
-                        running = False
-                        next_state = EXIT
-                elif menu_state == PROLOGUE:
-                    if len(prologue) == 0 and current_line == "":
-                        if point_in_rect((mouse_x, mouse_y), prologue_play_rect):
-                            running = False
-                            next_state = MAIN_LOOP
-                    else:
-                        if current_line != "":
-                            dialog_display[len(dialog_display) - 1] += current_line
-                            current_line = ""
-                        while len(prologue[0]) != 0:
-                            dialog_display.append(prologue[0][0])
-                            prologue[0] = prologue[0][1:]
-                        prologue = prologue[1:]
-
-        if menu_state == PROLOGUE:
-            if len(prologue) != 0 or current_line != "":
-                if current_line == "":
-                    current_line = prologue[0][0]
-                    prologue[0] = prologue[0][1:]
-                    if len(prologue[0]) == 0:
-                        prologue = prologue[1:]
-                    dialog_display.append("")
-                dialog_timer += dt
-                if dialog_timer >= dialog_char_rate:
-                    dialog_timer -= dialog_char_rate
-                    dialog_display[len(dialog_display) - 1] += current_line[0]
-                    current_line = current_line[1:]
+    def on_click():
+        nonlocal menu_state, running, next_state
+        if menu_state == TITLE:
+            if point_in_rect((mouse_x, mouse_y), play_rect):
+                menu_state = PROLOGUE
+                compositor.start_transition(TRANSITION_CROSSFADE)
+            elif point_in_rect((mouse_x, mouse_y), exit_rect):
+                running = False
+                next_state = EXIT
+        elif menu_state == PROLOGUE:
+            if prologue.is_done():
+                if point_in_rect((mouse_x, mouse_y), prologue_play_rect):
+                    running = False
+                    next_state = MAIN_LOOP
+            else:
+                prologue.skip()
 
-        # Render
-        clear_display()
+    input_handlers = {("left click", True): on_click}
 
+    dirty_regions = DirtyRegions()
+    rendered_menu_state = TITLE
+
+    while running:
+        profiler.phase("input")
+        handle_input()
+        dispatch_input(input_handlers)
+
+        profiler.phase("update")
+        asset_preloader.pump()
+        for update_step in range(0, update_steps):
+            compositor.update(dt)
+            if menu_state == PROLOGUE:
+                prologue.update(dt)
+
+        # Render, only the parts of the menu that changed since the last frame are redrawn
+        profiler.phase("render")
+        if show_fps or menu_state != rendered_menu_state or compositor.needs_full_redraw():
+            dirty_regions.reset()
+        rendered_menu_state = menu_state
         if menu_state == TITLE:
-            display.blit(get_image("cover", False), (0, screen_center[1] - 360))
-            display.blit(title_text, (screen_center[0] - (title_text.get_width() // 2), int(DISPLAY_HEIGHT * 0.15)))
-            display.blit(play_text, (play_rect[0] + 10, play_rect[1] + 5))
-            pygame.draw.rect(display, WHITE, play_rect, not point_in_rect((mouse_x, mouse_y), play_rect))
-            display.blit(exit_text, (exit_rect[0] + 10, exit_rect[1] + 5))
-            pygame.draw.rect(display, WHITE, exit_rect, not point_in_rect((mouse_x, mouse_y), exit_rect))
+            dirty_regions.update("play", play_rect, point_in_rect((mouse_x, mouse_y), play_rect))
+            dirty_regions.update("exit", exit_rect, point_in_rect((mouse_x, mouse_y), exit_rect))
         elif menu_state == PROLOGUE:
-            for i in range(0, len(dialog_display)):
-                text = font_prologue.render(dialog_display[i], False, WHITE)
-                display.blit(text, (screen_center[0] - (text.get_width() // 2), 25 + (30 * i)))
-            if len(prologue) == 0 and current_line == "":
-                display.blit(play_text, (prologue_play_rect[0] + 10, prologue_play_rect[1] + 5))
-                pygame.draw.rect(display, WHITE, prologue_play_rect, not point_in_rect((mouse_x, mouse_y), prologue_play_rect))
+            for i in range(0, len(prologue.lines)):
+                dirty_regions.update(("line", i), (0, 25 + (30 * i), DISPLAY_WIDTH, fonts.prologue.get_linesize()), prologue.get_typed(i))
+            dirty_regions.update("play", prologue_play_rect, (prologue.is_done(), point_in_rect((mouse_x, mouse_y), prologue_play_rect)))
+        dirty_regions.update("loading", (0, DISPLAY_HEIGHT - LOADING_BAR_HEIGHT, DISPLAY_WIDTH, LOADING_BAR_HEIGHT), asset_preloader.loaded)
+        dirty_rects = dirty_regions.take()
+
+        for clip_rect in ([None] if dirty_rects is None else dirty_rects):
+            display.set_clip(clip_rect)
+            clear_display()
+
+            if menu_state == TITLE:
+                display.blit(get_image("cover", False), (0, screen_center[1] - 360))
+                display.blit(title_text, (screen_center[0] - (title_text.get_width() // 2), int(DISPLAY_HEIGHT * 0.15)))
+                display.blit(play_text, (play_rect[0] + 10, play_rect[1] + 5))
+                pygame.draw.rect(display, WHITE, play_rect, not point_in_rect((mouse_x, mouse_y), play_rect))
+                display.blit(exit_text, (exit_rect[0] + 10, exit_rect[1] + 5))
+                pygame.draw.rect(display, WHITE, exit_rect, not point_in_rect((mouse_x, mouse_y), exit_rect))
+            elif menu_state == PROLOGUE:
+                prologue.draw(screen_center[0], 25, 30, True)
+                if prologue.is_done():
+                    display.blit(play_text, (prologue_play_rect[0] + 10, prologue_play_rect[1] + 5))
+                    pygame.draw.rect(display, WHITE, prologue_play_rect, not point_in_rect((mouse_x, mouse_y), prologue_play_rect))
+
+            if not asset_preloader.is_done():
+                render_loading_bar()
+
+        display.set_clip(None)
+        compositor.render()
 
         if show_fps:
-            render_fps()
-        flip_display()
+            render_profiler()
+        flip_display(dirty_rects)
         tick()
 
-    pygame.mixer.music.stop()
     if next_state == MAIN_LOOP:
+        compositor.start_transition(TRANSITION_FADE)
         game()
 
 
 def handle_input():
     global mouse_x, mouse_y
 
-    for event in pygame.event.get():
+    if input_replay is not None:
+        pygame.event.pump()
+        input_replay.play_frame()
+        return
+
+    events = []
+    for event in frame_governor.take_events():
         if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+            end_session(True)
             pygame.quit()
             sys.exit()
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_w:
-                input_queue.append(("player up", True))
-                input_states["player up"] = True
-            elif event.key == pygame.K_d:
-                input_queue.append(("player right", True))
-                input_states["player right"] = True
-            elif event.key == pygame.K_s:
-                input_queue.append(("player down", True))
-                input_states["player down"] = True
-            elif event.key == pygame.K_a:
-                input_queue.append(("player left", True))
-                input_states["player left"] = True
-            elif event.key == pygame.K_x:
-                input_queue.append(("kill", True))
-                input_states["kill"] = True
-        elif event.type == pygame.KEYUP:
-            if event.key == pygame.K_w:
-                input_queue.append(("player up", False))
-                input_states["player up"] = False
-            elif event.key == pygame.K_d:
-                input_queue.append(("player right", False))
-                input_states["player right"] = False
-            elif event.key == pygame.K_s:
-                input_queue.append(("player down", False))
-                input_states["player down"] = False
-            elif event.key == pygame.K_a:
-                input_queue.append(("player left", False))
-                input_states["player left"] = False
-            elif event.key == pygame.K_x:
-                input_queue.append(("kill", False))
-                input_states["kill"] = False
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            if event.button == pygame.BUTTON_LEFT:
-                input_queue.append(("left click", True))
-                input_states["left click"] = True
-        elif event.type == pygame.MOUSEBUTTONUP:
-            if event.button == pygame.BUTTON_LEFT:
-                input_queue.append(("left click", False))
-                input_states["left click"] = False
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F2 and show_fps:
+            profiler.dump_csv("profile_" + time.strftime("%Y%m%d_%H%M%S") + ".csv")
+        elif event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+            action = key_bindings.get(event.key)
+            if action is not None:
+                events.append((action, event.type == pygame.KEYDOWN))
+        elif event.type == pygame.MOUSEBUTTONDOWN or event.type == pygame.MOUSEBUTTONUP:
+            action = MOUSE_BINDINGS.get(event.button)
+            if action is not None:
+                events.append((action, event.type == pygame.MOUSEBUTTONDOWN))
         elif event.type == pygame.MOUSEMOTION:
             mouse_pos = pygame.mouse.get_pos()
             mouse_x = int(mouse_pos[0] / SCALE)
             mouse_y = int(mouse_pos[1] / SCALE)
 
+    for event in events:
+        input_queue.append(event)
+        input_states[event[0]] = event[1]
+    if input_recorder is not None:
+        input_recorder.record_frame(events)
+
+
+def dispatch_input(handlers):
+    """
+    Hands each queued event, oldest first, to its handler in handlers, a dict keyed by (action, pressed). Events
+    with no handler are dropped
+    """
+    while len(input_queue) != 0:
+        handler = handlers.get(input_queue.popleft())
+        if handler is not None:
+            handler()
+
 
 def clear_display():
     pygame.draw.rect(display, BLACK, (0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT), False)
 
 
-def flip_display():
+def flip_display(dirty_rects=None):
+    """
+    Scales the display onto the screen if needed and presents it. If dirty_rects is given only those parts of the
+    display are scaled and presented
+    """
     global frames
 
-    pygame.transform.scale(display, (SCREEN_WIDTH, SCREEN_HEIGHT), screen)
-    pygame.display.flip()
+    profiler.phase("present")
+    if present_mode == PRESENT_GPU:
+        pygame.display.flip()
+    elif present_mode == PRESENT_DIRECT:
+        if dirty_rects is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty_rects)
+    elif dirty_rects is None:
+        pygame.transform.scale(display, screen.get_size(), screen)
+        pygame.display.flip()
+    else:
+        # Each rect is grown out to the scale's pixel grid, the display pixels that scale to a whole number of
+        # screen pixels. Otherwise its edges are sampled differently from a full frame scale and leave seams on
+        # screen when the scale isn't a whole number
+        screen_width, screen_height = screen.get_size()
+        grid_x = DISPLAY_WIDTH // math.gcd(DISPLAY_WIDTH, screen_width)
+        grid_y = DISPLAY_HEIGHT // math.gcd(DISPLAY_HEIGHT, screen_height)
+        screen_rects = []
+        for rect in dirty_rects:
+            rect = rect.clip(display.get_rect())
+            if rect.width <= 0 or rect.height <= 0:
+                continue
+            left, top = (rect.left // grid_x) * grid_x, (rect.top // grid_y) * grid_y
+            right, bottom = min(-(-rect.right // grid_x) * grid_x, DISPLAY_WIDTH), min(-(-rect.bottom // grid_y) * grid_y, DISPLAY_HEIGHT)
+            screen_left, screen_top = left * screen_width // DISPLAY_WIDTH, top * screen_height // DISPLAY_HEIGHT
+            screen_rect = pygame.Rect(screen_left, screen_top, (right * screen_width // DISPLAY_WIDTH) - screen_left, (bottom * screen_height // DISPLAY_HEIGHT) - screen_top)
+            pygame.transform.scale(display.subsurface((left, top, right - left, bottom - top)), screen_rect.size, screen.subsurface(screen_rect))
+            screen_rects.append(screen_rect)
+        pygame.display.update(screen_rects)
+    frame_governor.frame_presented(dirty_rects is None or len(dirty_rects) != 0)
     frames += 1
 
 
-def render_fps():
-    text = font_small.render("FPS: " + str(fps), False, BLACK)
-    display.blit(text, (0, 0))
+PROFILER_COLORS = {"input": (0, 200, 255), "update": (0, 255, 0), "collision": (255, 60, 60), "npcs": (0, 140, 0), "render": (255, 200, 0), "background": (160, 110, 0), "overlay": (120, 120, 120), "present": (255, 0, 255)}
+PROFILER_GRAPH_HEIGHT = 150  # Tall enough for a line of text per phase beside the graph
+PROFILER_GRAPH_MS = 33.3  # Frame time at the top of the graph, 60 FPS sits at the halfway line
+
+
+def render_profiler():
+    """
+    Draws the FPS, a graph of recent frame times split by phase, and the average time of each phase
+    """
+    profiler.phase("overlay")
+
+    graph_x = 0
+    graph_y = DISPLAY_HEIGHT - PROFILER_GRAPH_HEIGHT
+    pixels_per_second = PROFILER_GRAPH_HEIGHT / (PROFILER_GRAPH_MS / SECOND)
+    pygame.draw.rect(display, BLACK, (graph_x, graph_y, PROFILER_HISTORY + 100, PROFILER_GRAPH_HEIGHT))
+    for frame_number, frame_times in enumerate(profiler.history):
+        bar_bottom = DISPLAY_HEIGHT
+        for phase in PROFILER_PHASES:
+            bar_top = max(bar_bottom - (frame_times.get(phase, 0) * pixels_per_second), graph_y)
+            if bar_top < bar_bottom:
+                pygame.draw.line(display, PROFILER_COLORS[phase], (graph_x + frame_number, bar_bottom), (graph_x + frame_number, bar_top))
+            bar_bottom = bar_top
+    target_y = DISPLAY_HEIGHT - (PROFILER_GRAPH_HEIGHT // 2)
+    pygame.draw.line(display, WHITE, (graph_x, target_y), (graph_x + PROFILER_HISTORY, target_y))
+
+    text = render_text(fonts.small, "FPS: " + str(fps), False, WHITE)
+    display.blit(text, (graph_x + PROFILER_HISTORY + 5, graph_y))
+    averages = profiler.get_averages()
+    for i in range(0, len(PROFILER_PHASES)):
+        phase = PROFILER_PHASES[i]
+        text = render_text(fonts.small, phase + ": " + ("%.2f" % (averages[phase] * SECOND)) + "ms", False, PROFILER_COLORS[phase])
+        display.blit(text, (graph_x + PROFILER_HISTORY + 5, graph_y + (14 * (i + 1))))
+    image_stats = image_cache.get_stats()
+    text = render_text(fonts.small, "images: " + ("%.1f" % (image_stats["resident_bytes"] / (1024 * 1024))) + "MB", False, WHITE)
+    display.blit(text, (graph_x + PROFILER_HISTORY + 5, graph_y + (14 * (len(PROFILER_PHASES) + 1))))
+
+
+# Frame pacing, once nothing on screen has changed for a while frames are only drawn when input arrives or a
+# timeout passes. The timeout is as long as the update accumulator can catch up on, so no simulation time is lost
+IDLE_AFTER_FRAMES = 30
+IDLE_FRAME_TIME = MAX_UPDATES_PER_FRAME * UPDATE_TIME
+
+
+class FrameGovernor():
+    """
+    Counts the presented frames that didn't redraw anything. Past IDLE_AFTER_FRAMES of them tick() waits on the event
+    queue instead of the clock, the first input wakes it and frames run at TARGET_FPS again until the screen settles
+    """
+
+    def __init__(self):
+        self.unchanged_frames = 0
+        self.woken_event = None
+
+    def frame_presented(self, changed):
+        if changed:
+            self.unchanged_frames = 0
+        else:
+            self.unchanged_frames += 1
+
+    def is_idle(self):
+        return self.unchanged_frames >= IDLE_AFTER_FRAMES
+
+    def wait(self):
+        """
+        Blocks until there's an event or IDLE_FRAME_TIME has passed. An event that ends the wait is kept for
+        handle_input() to take ahead of the queue, posting it back would put it behind anything that came after it
+        """
+        if pygame.event.peek():
+            self.unchanged_frames = 0
+            return
+        event = pygame.event.wait(int(IDLE_FRAME_TIME))
+        if event.type != pygame.NOEVENT:
+            self.woken_event = event
+            self.unchanged_frames = 0
+
+    def take_events(self):
+        """
+        Returns every pending event in the order it arrived, starting with the one that ended the last wait
+        """
+        events = pygame.event.get()
+        if self.woken_event is not None:
+            events.insert(0, self.woken_event)
+            self.woken_event = None
+        return events
+
+
+frame_governor = FrameGovernor()
 
 
 def tick():
-    global before_time, before_sec, fps, frames, dt
+    global before_time, before_sec, fps, frames, update_accumulator, update_steps, interpolation
+
+    audio.update()
+    profiler.end_frame()
 
-    # Update delta based on the time elapsed
+    # Work out how many fixed updates the time elapsed is worth, dropping time if we've fallen too far behind
     after_time = pygame.time.get_ticks()
-    dt = (after_time - before_time) / UPDATE_TIME
+    if lockstep:
+        update_steps = 1
+        interpolation = 1
+    else:
+        update_accumulator += (after_time - before_time) / UPDATE_TIME
+        update_accumulator = min(update_accumulator, MAX_UPDATES_PER_FRAME)
+        update_steps = int(update_accumulator)
+        update_accumulator -= update_steps
+        interpolation = update_accumulator
 
     # Update fps if a second has passed
     if after_time - before_sec >= SECOND:
@@ -1210,14 +2738,25 @@ def tick():
         before_sec += SECOND
     before_time = pygame.time.get_ticks()
 
-    # Update pygame clock
-    clock.tick(TARGET_FPS)
+    # Update pygame clock, rendering can run uncapped since updates are decoupled from frames. Replays and lockstep
+    # never wait on input, their frames and steps come from the recording or are fixed, and a recording already
+    # holds however many steps the frame after an idle wait ran
+    if uncapped or lockstep or input_replay is not None:
+        clock.tick()
+    elif frame_governor.is_idle():
+        frame_governor.wait()
+        clock.tick()
+    else:
+        clock.tick(TARGET_FPS)
 
 
 if __name__ == "__main__":
+    parse_flags(sys.argv)
+    app.start()
     before_time = pygame.time.get_ticks()
     before_sec = before_time
     # game()
     menu()
-    pygame.mixer.music.stop()
+    end_session(False)
+    audio.stop_music()
     pygame.quit()
@@ -0,0 +1,70 @@
+"""
+Scenarios, who has symptoms, who is actually sick and who each of the other NPCs blames
+
+Kept apart from main.py and free of pygame so scenarios.py can roll them in bulk without starting the game.
+"""
+import collections
+
+SCENARIO_SYMPTOMS = 5
+SCENARIO_BLAME = 7
+SCENARIO_NEVER_SYMPTOMATIC = (8,)  # Tweak, who has no coughing animation
+
+
+class Scenario():
+    def __init__(self, symptoms, sick, blame):
+        self.symptoms = symptoms
+        self.sick = sick
+        self.blame = blame  # Maps each NPC giving a clue to the NPC they blame
+
+
+def generate_scenario(rng, npc_count, number_with_symptoms=SCENARIO_SYMPTOMS, number_with_blame=SCENARIO_BLAME, never_symptomatic=SCENARIO_NEVER_SYMPTOMATIC):
+    """
+    Rolls a scenario using only rng, either the random module or a random.Random, so a seed always gives the same
+    case. Half of the blame (rounded down) falls on the sick NPC and the rest is spread as evenly as possible over
+    the others with symptoms
+    """
+    candidates = [i for i in range(0, npc_count) if i not in never_symptomatic]
+    if number_with_symptoms > len(candidates):
+        raise ValueError("Can't give " + str(number_with_symptoms) + " NPCs symptoms, only " + str(len(candidates)) + " can have them")
+    if number_with_blame > npc_count - number_with_symptoms:
+        raise ValueError("Can't have " + str(number_with_blame) + " NPCs give clues, only " + str(npc_count - number_with_symptoms) + " don't have symptoms")
+    blame_on_others = number_with_blame - (number_with_blame // 2)
+    if blame_on_others > 0 and number_with_symptoms < 2:
+        raise ValueError("Blame can only fall on NPCs with symptoms, at least 2 are needed")
+
+    symptoms = rng.sample(candidates, number_with_symptoms)
+    sick = rng.choice(symptoms)
+    others = [i for i in symptoms if i != sick]
+    rng.shuffle(others)
+    blamed = [sick] * (number_with_blame // 2) + [others[i % len(others)] for i in range(0, blame_on_others)]
+    rng.shuffle(blamed)
+    blamers = rng.sample([i for i in range(0, npc_count) if i not in symptoms], number_with_blame)
+
+    return Scenario(symptoms, sick, dict(zip(blamers, blamed)))
+
+
+def validate_scenario(scenario, npc_count, number_with_symptoms=SCENARIO_SYMPTOMS, number_with_blame=SCENARIO_BLAME, never_symptomatic=SCENARIO_NEVER_SYMPTOMATIC):
+    """
+    Raises a ValueError if the scenario breaks any of the rules generate_scenario() is meant to follow
+    """
+    if len(set(scenario.symptoms)) != number_with_symptoms or any(i < 0 or i >= npc_count or i in never_symptomatic for i in scenario.symptoms):
+        raise ValueError("Bad symptoms " + str(scenario.symptoms))
+    if scenario.sick not in scenario.symptoms:
+        raise ValueError("Sick NPC " + str(scenario.sick) + " has no symptoms")
+    if len(scenario.blame) != number_with_blame or any(i in scenario.symptoms or i < 0 or i >= npc_count for i in scenario.blame):
+        raise ValueError("Bad NPCs giving clues " + str(list(scenario.blame)))
+    if any(i not in scenario.symptoms for i in scenario.blame.values()):
+        raise ValueError("Blame falls on an NPC without symptoms " + str(scenario.blame))
+
+
+def get_blame_counts(scenario):
+    return collections.Counter(scenario.blame.values())
+
+
+def is_scenario_solvable(scenario):
+    """
+    Returns whether talking to everyone points to the sick NPC, by them being blamed strictly more than anyone else
+    """
+    blame_counts = get_blame_counts(scenario)
+    sick_blame = blame_counts[scenario.sick]
+    return sick_blame > 0 and all(count < sick_blame for npc, count in blame_counts.items() if npc != scenario.sick)
@@ -0,0 +1,134 @@
+"""
+Generates scenarios in bulk across a process pool and reports how often they can be solved and how the clues are
+spread, for tuning the number of NPCs with symptoms and giving clues as the roster grows
+
+    python scenarios.py --count 1000000
+    python scenarios.py --count 1000000 --npcs 40 --symptoms 8 --blame 20 --output scenarios.json
+
+Every scenario is checked with validate_scenario(). A scenario counts as solvable when the sick NPC is blamed
+at least once and strictly more than anyone else, the margin is how many more times they were blamed than the next most blamed NPC.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import collections
+import multiprocessing
+
+from scenario import SCENARIO_SYMPTOMS, SCENARIO_BLAME, SCENARIO_NEVER_SYMPTOMATIC, generate_scenario, validate_scenario, get_blame_counts, is_scenario_solvable
+
+CHUNK_SIZE = 20000
+
+
+def run_chunk(chunk):
+    seed, count, npc_count, number_with_symptoms, number_with_blame, never_symptomatic = chunk
+    rng = random.Random(seed)
+    stats = {
+        "solvable": 0,
+        "margin": collections.Counter(),
+        "npcs blamed": collections.Counter(),
+        "sick": collections.Counter(),
+        "symptoms": collections.Counter(),
+        "giving clues": collections.Counter(),
+    }
+    for i in range(0, count):
+        scenario = generate_scenario(rng, npc_count, number_with_symptoms, number_with_blame, never_symptomatic)
+        validate_scenario(scenario, npc_count, number_with_symptoms, number_with_blame, never_symptomatic)
+
+        blame_counts = get_blame_counts(scenario)
+        sick_blame = blame_counts.pop(scenario.sick, 0)
+        stats["margin"][sick_blame - max(blame_counts.values(), default=0)] += 1
+        stats["npcs blamed"][len(blame_counts) + (1 if sick_blame > 0 else 0)] += 1
+        if is_scenario_solvable(scenario):
+            stats["solvable"] += 1
+        stats["sick"][scenario.sick] += 1
+        stats["symptoms"].update(scenario.symptoms)
+        stats["giving clues"].update(scenario.blame.keys())
+
+    return stats
+
+
+def run_batch(count, npc_count, number_with_symptoms, number_with_blame, never_symptomatic, seed, processes):
+    chunks = []
+    for i in range(0, count, CHUNK_SIZE):
+        chunks.append((seed + i, min(CHUNK_SIZE, count - i), npc_count, number_with_symptoms, number_with_blame, never_symptomatic))
+
+    totals = None
+    with multiprocessing.Pool(processes) as pool:
+        for stats in pool.imap_unordered(run_chunk, chunks):
+            if totals is None:
+                totals = stats
+                continue
+            totals["solvable"] += stats["solvable"]
+            for key in stats:
+                if key != "solvable":
+                    totals[key].update(stats[key])
+
+    return totals
+
+
+def get_spread(counter, npc_count, never):
+    """
+    Returns the lowest and highest share of scenarios any NPC got, out of the NPCs that can be picked at all
+    """
+    shares = [counter[i] for i in range(0, npc_count) if i not in never]
+    total = sum(shares)
+    if total == 0:
+        return (0, 0)
+    return (min(shares) / total, max(shares) / total)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate scenarios in bulk and report solvability and clue statistics")
+    parser.add_argument("--count", type=int, default=1000000)
+    parser.add_argument("--npcs", type=int, default=14, help="Roster size, the game has 14 NPCs")
+    parser.add_argument("--symptoms", type=int, default=SCENARIO_SYMPTOMS)
+    parser.add_argument("--blame", type=int, default=SCENARIO_BLAME)
+    parser.add_argument("--never", type=int, nargs="*", default=list(SCENARIO_NEVER_SYMPTOMATIC), help="NPCs that never get symptoms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None, help="Worker processes, defaults to one per CPU")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    never_symptomatic = tuple(args.never)
+    try:
+        # Catches impossible settings before starting any workers
+        generate_scenario(random.Random(args.seed), args.npcs, args.symptoms, args.blame, never_symptomatic)
+    except ValueError as error:
+        print(error)
+        sys.exit(1)
+
+    start_time = time.perf_counter()
+    totals = run_batch(args.count, args.npcs, args.symptoms, args.blame, never_symptomatic, args.seed, args.processes)
+    elapsed = time.perf_counter() - start_time
+
+    print(str(args.count) + " scenarios in " + ("%.2f" % elapsed) + "s (" + str(int(args.count / elapsed)) + " per second)")
+    print("solvable from blame alone: " + ("%.2f" % (100 * totals["solvable"] / args.count)) + "%")
+    print("margin of blame on the sick NPC over the next most blamed:")
+    for margin in sorted(totals["margin"]):
+        print("    " + str(margin).rjust(3) + "  " + ("%.2f" % (100 * totals["margin"][margin] / args.count)).rjust(6) + "%")
+    print("NPCs blamed per scenario:")
+    for blamed in sorted(totals["npcs blamed"]):
+        print("    " + str(blamed).rjust(3) + "  " + ("%.2f" % (100 * totals["npcs blamed"][blamed] / args.count)).rjust(6) + "%")
+    for key in ("sick", "symptoms", "giving clues"):
+        low, high = get_spread(totals[key], args.npcs, never_symptomatic if key != "giving clues" else ())
+        print("share of " + key + " per NPC: " + ("%.2f" % (100 * low)) + "% to " + ("%.2f" % (100 * high)) + "%")
+
+    if args.output is not None:
+        results = {
+            "count": args.count,
+            "npcs": args.npcs,
+            "symptoms": args.symptoms,
+            "blame": args.blame,
+            "never": args.never,
+            "seed": args.seed,
+            "solvable": totals["solvable"] / args.count,
+            "margin": {str(margin): totals["margin"][margin] for margin in sorted(totals["margin"])},
+            "npcs blamed": {str(blamed): totals["npcs blamed"][blamed] for blamed in sorted(totals["npcs blamed"])},
+        }
+        for key in ("sick", "symptoms", "giving clues"):
+            results[key] = [totals[key][i] for i in range(0, args.npcs)]
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+        print("Results written to " + args.output)
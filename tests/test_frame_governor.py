@@ -0,0 +1,46 @@
+import pygame
+import pytest
+
+import main
+
+
+@pytest.fixture
+def event_queue():
+    pygame.display.init()
+    pygame.display.set_mode((64, 64))
+    pygame.event.get()
+    main.input_queue.clear()
+    yield
+    main.input_queue.clear()
+    main.input_states.clear()
+    main.frame_governor.woken_event = None
+    pygame.display.quit()
+
+
+def test_wait_keeps_events_in_order(event_queue, monkeypatch):
+    wait = pygame.event.wait
+
+    def wait_for_key_press(timeout):
+        # The key goes down while the game waits and comes back up before handle_input() gets to the queue
+        pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_w))
+        event = wait(timeout)
+        pygame.event.post(pygame.event.Event(pygame.KEYUP, key=pygame.K_w))
+        return event
+
+    monkeypatch.setattr(pygame.event, "wait", wait_for_key_press)
+    for i in range(0, 20):
+        main.frame_governor.wait()
+        main.handle_input()
+        assert list(main.input_queue) == [("player up", True), ("player up", False)]
+        assert not main.input_states["player up"]
+        main.input_queue.clear()
+
+
+def test_wait_returns_at_once_with_events_pending(event_queue, monkeypatch):
+    monkeypatch.setattr(pygame.event, "wait", lambda timeout: pytest.fail("waited with events pending"))
+    main.frame_governor.unchanged_frames = main.IDLE_AFTER_FRAMES
+    pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_w))
+    main.frame_governor.wait()
+    assert not main.frame_governor.is_idle()
+    main.handle_input()
+    assert list(main.input_queue) == [("player up", True)]
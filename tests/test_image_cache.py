@@ -0,0 +1,59 @@
+import pygame
+
+import main
+
+
+def make_surface(width, height):
+    return pygame.Surface((width, height), 0, 32)
+
+
+def test_least_recently_used_is_evicted_by_bytes():
+    surface_bytes = main.get_surface_bytes(make_surface(16, 16))
+    cache = main.ImageCache(surface_bytes * 3)
+    evicted = []
+    cache.listeners.append(evicted.append)
+    for key in ("a", "b", "c"):
+        cache.put(key, make_surface(16, 16))
+    assert cache.resident_bytes == surface_bytes * 3
+
+    # Using "a" makes "b" the least recently used
+    assert cache.get("a") is not None
+    cache.put("d", make_surface(16, 16))
+    assert evicted == ["b"]
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get_stats()["evictions"] == 1
+
+    # A big entry pushes out as many entries as it needs to
+    cache.put("e", make_surface(32, 16))
+    assert evicted == ["b", "c", "a"]
+    assert list(cache.entries) == ["d", "e"]
+    assert cache.resident_bytes == surface_bytes * 3
+
+
+def test_newest_entry_is_kept_over_budget():
+    cache = main.ImageCache(1)
+    cache.put("a", make_surface(16, 16))
+    cache.put("b", make_surface(16, 16))
+    assert list(cache.entries) == ["b"]
+
+
+def test_replacing_an_entry_and_explicit_sizes():
+    cache = main.ImageCache(1000)
+    cache.put("tiles", [[make_surface(4, 4)]], 600)
+    cache.put("tiles", [[make_surface(4, 4)]], 300)
+    assert cache.resident_bytes == 300
+    cache.put("big", make_surface(4, 4), 800)
+    assert "tiles" not in cache
+    assert cache.resident_bytes == 800
+
+
+def test_faded_image_leaves_the_cached_image_alone():
+    cached = make_surface(8, 8)
+    main.image_cache.put("test-fade", cached)
+    faded = main.get_image("test-fade", False, alpha=100)
+    assert faded.get_alpha() == 100
+    assert cached.get_alpha() is None
+    assert main.get_image("test-fade", False) is cached
+    assert main.get_image("test-fade", False, alpha=50).get_alpha() == 50
+    assert faded.get_alpha() == 100
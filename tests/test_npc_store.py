@@ -0,0 +1,36 @@
+import numpy
+
+import main
+
+
+def make_store():
+    store = main.NpcStore(2)
+    for i in range(0, 3):
+        store.add()
+        store.set_patrol(i, True, (100, 0), (103, 0))
+        store.position[i] = (100, 50)
+    return store
+
+
+def test_only_the_given_npcs_move_and_patrol():
+    store = make_store()
+    store.update_patrols([0, 1])
+    assert store.velocity[:3, 0].tolist() == [1, 1, 0]
+
+    for step in range(0, 5):
+        moved = store.move(1, [0, 1], 1)
+        assert moved.tolist() == [0]
+        store.update_patrols([0, 1])
+    # The first NPC turned around at the end of its route, the paused and sleeping ones stayed put
+    assert store.position[:3, 0].tolist() == [101, 100, 100]
+    assert store.velocity[:3, 0].tolist() == [-1, 1, 0]
+    assert store.get_moving([1, 2]).tolist() == [1]
+
+
+def test_no_npcs_awake():
+    store = make_store()
+    store.velocity[:3] = 1
+    assert store.move(1, set(), -1).tolist() == []
+    store.update_patrols(set())
+    assert numpy.all(store.position[:3] == (100, 50))
+    assert store.get_moving(set()).tolist() == []
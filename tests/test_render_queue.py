@@ -0,0 +1,69 @@
+import random
+
+import main
+
+
+def get_order(queue):
+    keys_by_command = {id(command): key for key, command in queue.commands_by_key.items()}
+    return [keys_by_command[id(command)] for command in queue.commands]
+
+
+def make_queue(keys):
+    queue = main.RenderQueue()
+    for key in keys:
+        queue.add(key, main.LAYER_ENTITIES)
+    return queue
+
+
+def test_sorts_by_depth():
+    queue = make_queue(["player", "a", "b"])
+    queue.update("player", 300, None, (0, 0))
+    queue.update("a", 100, None, (0, 0))
+    queue.update("b", 200, None, (0, 0))
+    queue.sort()
+    assert get_order(queue) == ["a", "b", "player"]
+
+
+def test_ties_go_to_whatever_was_added_first():
+    queue = make_queue(["player", ("npc", 0), ("npc", 1)])
+    queue.update(("npc", 1), 100, None, (0, 0))
+    queue.update(("npc", 0), 100, None, (0, 0))
+    queue.update("player", 100, None, (0, 0))
+    queue.sort()
+    assert get_order(queue) == ["player", ("npc", 0), ("npc", 1)]
+
+    # The player stays in front of an npc it walks level with, whichever side it came from
+    queue.update("player", 150, None, (0, 0))
+    queue.sort()
+    queue.update("player", 100, None, (0, 0))
+    queue.sort()
+    assert get_order(queue) == ["player", ("npc", 0), ("npc", 1)]
+
+
+def test_matches_a_full_sort_as_depths_change():
+    rng = random.Random(2)
+    keys = ["player"] + [("npc", i) for i in range(0, 50)]
+    queue = make_queue(keys)
+    depths = {key: rng.randint(0, 1000) for key in keys}
+    for frame in range(0, 100):
+        for key in keys:
+            depths[key] += rng.randint(-3, 3)
+            queue.update(key, depths[key], None, (0, 0))
+        queue.sort()
+        assert get_order(queue) == sorted(keys, key=lambda key: (depths[key], keys.index(key)))
+
+
+def test_layers_come_before_depth():
+    queue = main.RenderQueue()
+    queue.add("front", main.LAYER_ENTITIES + 1)
+    queue.add("back", main.LAYER_ENTITIES)
+    queue.update("front", 0, None, (0, 0))
+    queue.update("back", 1000, None, (0, 0))
+    queue.sort()
+    assert get_order(queue) == ["back", "front"]
+
+
+def test_remove():
+    queue = make_queue(["a", "b"])
+    queue.remove("a")
+    assert get_order(queue) == ["b"]
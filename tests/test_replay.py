@@ -0,0 +1,94 @@
+"""
+Records a scripted session in a subprocess and replays it in another, since both end by exiting the process
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+RECORD_SCRIPT = """
+import sys
+import main
+import pygame
+
+main.parse_flags(["main.py", "--windowed", "--record", sys.argv[1]])
+main.app.start()
+
+
+def key(key, pressed):
+    pygame.event.post(pygame.event.Event(pygame.KEYDOWN if pressed else pygame.KEYUP, key=key))
+
+
+def click():
+    pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1))
+    pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONUP, button=1))
+
+
+def move_mouse(x, y):
+    main.mouse_x, main.mouse_y = x, y
+
+
+def check_in_game():
+    if len(main.sync_entities) != 0:
+        print("In game")
+
+
+# Plays from the menu, clicks through the prologue and walks around before quitting
+script = {
+    5: lambda: move_mouse(640, 411), 10: click, 40: click, 50: click, 60: click,
+    70: lambda: move_mouse(640, 641), 80: click,
+    100: lambda: key(pygame.K_w, True), 200: lambda: key(pygame.K_w, False),
+    210: lambda: key(pygame.K_d, True), 300: lambda: key(pygame.K_d, False),
+    320: lambda: key(pygame.K_s, True), 330: lambda: key(pygame.K_s, False),
+    390: check_in_game, 400: lambda: key(pygame.K_ESCAPE, True),
+}
+frame = [0]
+
+
+def on_frame(frame_time):
+    frame[0] += 1
+    if frame[0] in script:
+        script[frame[0]]()
+
+
+main.profiler.listeners.append(on_frame)
+main.menu()
+"""
+
+
+def run(args, cwd):
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy")
+    return subprocess.run([sys.executable] + args, cwd=cwd, env=env, capture_output=True, text=True, timeout=300).stdout
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("replay") / "session.json")
+    output = run(["-c", RECORD_SCRIPT, path], os.getcwd())
+    assert "In game" in output
+    assert "Recorded 401 frames" in output
+    return path
+
+
+def test_replay_stays_in_sync(recording):
+    output = run(["main.py", "--replay", recording], os.getcwd())
+    assert "Replayed 401 of 401 frames" in output
+    assert "out of sync" not in output
+
+
+def test_recording_only_holds_frames_with_input(recording):
+    frames = json.load(open(recording))["frames"]
+    assert len(frames) < 401
+    for entry in frames:
+        # Frame number, update steps, mouse position and events
+        assert len(entry) == 5
+
+
+def test_replay_notices_a_different_scenario(recording, tmp_path):
+    tampered = json.load(open(recording))
+    tampered["seed"] += 1
+    tampered_path = str(tmp_path / "tampered.json")
+    json.dump(tampered, open(tampered_path, "w"))
+    assert "out of sync" in run(["main.py", "--replay", tampered_path], os.getcwd())
@@ -0,0 +1,81 @@
+import random
+
+import pytest
+
+from scenario import Scenario, generate_scenario, get_blame_counts, is_scenario_solvable, validate_scenario
+
+NPC_COUNT = 20
+
+
+def test_generated_scenarios_follow_the_rules():
+    for seed in range(0, 200):
+        scenario = generate_scenario(random.Random(seed), NPC_COUNT)
+        validate_scenario(scenario, NPC_COUNT)
+        assert is_scenario_solvable(scenario)
+
+
+def test_same_seed_gives_the_same_scenario():
+    first = generate_scenario(random.Random(5), NPC_COUNT)
+    second = generate_scenario(random.Random(5), NPC_COUNT)
+    assert (first.symptoms, first.sick, first.blame) == (second.symptoms, second.sick, second.blame)
+
+
+@pytest.mark.parametrize("number_with_symptoms, number_with_blame", [(5, 7), (5, 8), (3, 9), (2, 4), (6, 1)])
+def test_blame_is_split_between_the_sick_and_the_others(number_with_symptoms, number_with_blame):
+    for seed in range(0, 50):
+        scenario = generate_scenario(random.Random(seed), NPC_COUNT, number_with_symptoms, number_with_blame)
+        validate_scenario(scenario, NPC_COUNT, number_with_symptoms, number_with_blame)
+        blame_counts = get_blame_counts(scenario)
+        assert blame_counts[scenario.sick] == number_with_blame // 2
+        others = [blame_counts[i] for i in scenario.symptoms if i != scenario.sick]
+        assert sum(others) == number_with_blame - (number_with_blame // 2)
+        assert max(others) - min(others) <= 1
+
+
+def test_no_blame():
+    scenario = generate_scenario(random.Random(1), NPC_COUNT, number_with_blame=0)
+    validate_scenario(scenario, NPC_COUNT, number_with_blame=0)
+    assert scenario.blame == {}
+    assert not is_scenario_solvable(scenario)
+
+
+def test_never_symptomatic_npcs_are_left_out():
+    for seed in range(0, 50):
+        scenario = generate_scenario(random.Random(seed), 6, 5, 1, never_symptomatic=(0,))
+        assert sorted(scenario.symptoms) == [1, 2, 3, 4, 5]
+
+
+def test_impossible_scenarios_raise():
+    rng = random.Random(1)
+    with pytest.raises(ValueError):
+        generate_scenario(rng, 5, number_with_symptoms=5)
+    with pytest.raises(ValueError):
+        generate_scenario(rng, 10, number_with_symptoms=5, number_with_blame=6)
+    with pytest.raises(ValueError):
+        generate_scenario(rng, 10, number_with_symptoms=1, number_with_blame=3)
+    # With a single blame it all falls on someone other than the sick NPC
+    with pytest.raises(ValueError):
+        generate_scenario(rng, 10, number_with_symptoms=1, number_with_blame=1)
+    # Without blame nobody else needs symptoms
+    generate_scenario(rng, 10, number_with_symptoms=1, number_with_blame=0)
+
+
+@pytest.mark.parametrize("scenario", [
+    Scenario([1, 2, 3, 4, 5], 1, {6: 1, 7: 2, 9: 3, 10: 4, 11: 5, 12: 1}),  # Too few clues
+    Scenario([1, 2, 3, 4, 4], 1, {6: 1, 7: 2, 9: 3, 10: 4, 11: 5, 12: 1, 13: 2}),  # Symptoms given twice
+    Scenario([1, 2, 3, 4, 8], 1, {6: 1, 7: 2, 9: 3, 10: 4, 11: 8, 12: 1, 13: 1}),  # Tweak can't have symptoms
+    Scenario([1, 2, 3, 4, 20], 1, {6: 1, 7: 2, 9: 3, 10: 4, 11: 20, 12: 1, 13: 1}),  # No such NPC
+    Scenario([1, 2, 3, 4, 5], 6, {6: 1, 7: 2, 9: 3, 10: 4, 11: 5, 12: 1, 13: 1}),  # Sick without symptoms
+    Scenario([1, 2, 3, 4, 5], 1, {5: 1, 7: 2, 9: 3, 10: 4, 11: 5, 12: 1, 13: 1}),  # Clue from someone with symptoms
+    Scenario([1, 2, 3, 4, 5], 1, {6: 1, 7: 2, 9: 3, 10: 4, 11: 5, 12: 1, 13: 14}),  # Blame on someone without symptoms
+])
+def test_validate_rejects_broken_scenarios(scenario):
+    with pytest.raises(ValueError):
+        validate_scenario(scenario, NPC_COUNT)
+
+
+def test_solvable_needs_the_sick_npc_blamed_the_most():
+    assert is_scenario_solvable(Scenario([1, 2], 1, {3: 1, 4: 1, 5: 2}))
+    assert not is_scenario_solvable(Scenario([1, 2], 1, {3: 1, 4: 2}))
+    assert not is_scenario_solvable(Scenario([1, 2], 1, {3: 2}))
+    assert not is_scenario_solvable(Scenario([1, 2], 1, {}))
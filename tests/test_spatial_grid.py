@@ -0,0 +1,50 @@
+import random
+
+import main
+
+
+def test_query_finds_every_overlapping_rect():
+    rng = random.Random(1)
+    grid = main.SpatialGrid(100)
+    rects = {}
+    for key in range(0, 200):
+        rects[key] = (rng.uniform(0, 2000), rng.uniform(0, 2000), rng.randint(1, 250), rng.randint(1, 250))
+        grid.insert(key, rects[key])
+
+    for i in range(0, 200):
+        query = (rng.uniform(0, 2000), rng.uniform(0, 2000), rng.randint(1, 300), rng.randint(1, 300))
+        found = grid.query(query)
+        assert found == sorted(found)
+        for key in rects:
+            if main.rects_collide(query, rects[key]):
+                assert key in found
+
+
+def test_rects_on_a_shared_cell_edge_are_found():
+    grid = main.SpatialGrid(100)
+    grid.insert("a", (90, 90, 10, 10))
+    assert grid.query((100, 100, 5, 5)) == ["a"]
+
+
+def test_move_and_remove():
+    grid = main.SpatialGrid(100)
+    grid.insert("a", (10, 10, 20, 20))
+    grid.insert("b", (450, 450, 20, 20))
+    assert grid.query((0, 0, 50, 50)) == ["a"]
+
+    grid.move("a", (460, 420, 20, 20))
+    assert grid.query((0, 0, 50, 50)) == []
+    assert grid.query((400, 400, 100, 100)) == ["a", "b"]
+
+    # Moving something the grid doesn't have yet inserts it
+    grid.move("c", (20, 20, 5, 5))
+    assert grid.query((0, 0, 50, 50)) == ["c"]
+
+    grid.remove("b")
+    assert grid.query((400, 400, 100, 100)) == ["a"]
+    assert "b" not in grid.cell_ranges
+
+
+def test_swept_rect_covers_both_positions():
+    assert main.get_swept_rect((100, 100, 10, 10), 5, -3) == (95, 100, 15, 13)
+    assert main.get_swept_rect((100, 100, 10, 10), -5, 3) == (100, 97, 15, 13)
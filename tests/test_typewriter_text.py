@@ -0,0 +1,86 @@
+import pygame
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module")
+def font():
+    pygame.font.init()
+    return pygame.font.Font(None, 24)
+
+
+def type_out(text):
+    # Runs updates until the page is typed and returns how many it took
+    updates = 0
+    while not text.is_page_typed():
+        text.update(1)
+        updates += 1
+    return updates
+
+
+def test_wrap_text_fits_lines_to_the_width(font):
+    text = "the quick brown fox jumps over the lazy dog " * 4
+    width = font.size("the quick brown fox")[0]
+    lines = main.wrap_text(font, text.strip(), width)
+    assert " ".join(lines) == text.strip()
+    for line in lines:
+        assert font.size(line)[0] <= width
+
+
+def test_wrap_text_keeps_newlines_and_blank_lines(font):
+    assert main.wrap_text(font, "one\n\ntwo", 1000) == ["one", "", "two"]
+
+
+def test_wrap_text_puts_a_word_wider_than_the_line_on_its_own(font):
+    long_word = "a" * 80
+    width = font.size("aaaa bbbb")[0]
+    lines = main.wrap_text(font, "aaaa " + long_word + " bbbb", width)
+    assert lines == ["aaaa", long_word, "bbbb"]
+
+
+def test_each_character_and_line_break_takes_one_step(font):
+    text = main.TypewriterText(font, main.WHITE, 1000, 1)
+    text.set_text("ab\n\ncd")
+    # Four characters and the two breaks between the three lines
+    assert type_out(text) == 6
+    assert [text.get_typed(i) for i in range(0, 3)] == [2, 0, 2]
+
+
+def test_blank_lines_pause_typing(font):
+    text = main.TypewriterText(font, main.WHITE, 1000, 1)
+    text.set_text("ab\ncd")
+    without_blank_line = type_out(text)
+    text.set_text("ab\n\n\ncd")
+    assert type_out(text) == without_blank_line + 2
+
+
+def test_char_rate_and_empty_text(font):
+    text = main.TypewriterText(font, main.WHITE, 1000, 4)
+    assert text.is_done()
+    text.set_text("abc")
+    assert type_out(text) == 12
+
+
+def test_paging_and_skipping(font):
+    text = main.TypewriterText(font, main.WHITE, 1000, 1, 2)
+    text.set_text("one\ntwo\nthree")
+    text.skip()
+    assert text.is_page_typed()
+    assert text.has_next_page()
+    assert not text.is_done()
+    text.next_page()
+    assert text.get_typed(2) == 0
+    assert type_out(text) == len("three")
+    assert text.is_done()
+
+
+def test_skip_stops_at_the_end_of_a_paragraph(font):
+    text = main.TypewriterText(font, main.WHITE, 1000, 1)
+    text.set_text("first\n\nsecond")
+    text.update(1)
+    text.skip()
+    assert text.get_typed(0) == len("first")
+    assert text.get_typed(2) == 0
+    text.skip()
+    assert text.is_done()